@@ -0,0 +1,124 @@
+# Benchmarks of the data layer, run against the configured database.
+# Every benchmark uses its own connection inside a transaction that is rolled back at the end,
+# so the database and the connection pool are left untouched.
+import contextlib
+import gc
+import time
+import tracemalloc
+
+import data_manager  # noqa: F401 registers the prepared statements
+import database_common
+
+
+@contextlib.contextmanager
+def benchmark_cursor(cursor_factory=database_common.Cursor):
+    connection = database_common.open_database()
+    try:
+        connection.autocommit = False
+        with connection.cursor(cursor_factory=cursor_factory) as cursor:
+            yield cursor
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def get_sample_params(cursor):
+    cursor.execute(
+        """
+        SELECT question.id AS question_id, question.user_id, user_account.email_address AS email,
+               user_account.user_name
+        FROM question
+        JOIN user_account ON user_account.id = question.user_id
+        ORDER BY question.id DESC
+        LIMIT 1"""
+    )
+    params = dict(cursor.fetchone())
+    cursor.execute("SELECT id FROM answer ORDER BY id DESC LIMIT 1")
+    answer = cursor.fetchone()
+    cursor.execute("SELECT id FROM question ORDER BY id DESC LIMIT 20")
+    params.update(
+        {
+            "answer_id": answer["id"] if answer else None,
+            "question_ids": [row["id"] for row in cursor.fetchall()],
+            "current_user_id": params["user_id"],
+            # the sample user owns the question, so the votes are not counted
+            "value": 1,
+            "reputation": 0,
+        }
+    )
+    return params
+
+
+def _planning_ms(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchone()["QUERY PLAN"][0]["Planning Time"]
+
+
+def benchmark_prepared_statements(iterations=200):
+    """Returns (statement name, plain planning ms, prepared planning ms, plain ms, prepared ms) per statement"""
+    results = []
+    with benchmark_cursor() as cursor:
+        sample = get_sample_params(cursor)
+        for statement in database_common.PREPARED_STATEMENTS.values():
+            params = {name: sample[name] for name in statement.params}
+            values = [params[name] for name in statement.params]
+            explain = "EXPLAIN (ANALYZE, FORMAT JSON) "
+            cursor.prepare(statement)
+
+            plain_planning = prepared_planning = 0.0
+            for _ in range(iterations):
+                plain_planning += _planning_ms(
+                    cursor, explain + statement.query, params
+                )
+                prepared_planning += _planning_ms(
+                    cursor, explain + statement.execute_query, values
+                )
+
+            started = time.perf_counter()
+            for _ in range(iterations):
+                cursor.execute(statement.query, params)
+                cursor.fetchall()
+            plain = time.perf_counter() - started
+            started = time.perf_counter()
+            for _ in range(iterations):
+                cursor.execute(statement, params)
+                cursor.fetchall()
+            prepared = time.perf_counter() - started
+
+            results.append(
+                (
+                    statement.name,
+                    plain_planning / iterations,
+                    prepared_planning / iterations,
+                    plain * 1000 / iterations,
+                    prepared * 1000 / iterations,
+                )
+            )
+    return results
+
+
+# question shaped rows, generated so the benchmark needs no data
+ROWS_QUERY = """
+    SELECT n AS id, now() - n * interval '1 second' AS submission_time, n %% 1000 AS view_number,
+           n %% 50 AS vote_number, 'user-' || n %% 100 AS user_id, 'Question ' || n AS title,
+           'Message ' || n || ' with a few more words' AS message, NULL AS image,
+           n %% 3 AS answer_count, n %% 7 = 0 AS is_solved
+    FROM generate_series(1, %(rows)s) AS n"""
+
+
+def benchmark_row_memory(rows=100000):
+    """Returns (cursor name, retained bytes, peak bytes, fetch seconds) of fetching rows rows with each cursor"""
+    results = []
+    for cursor_factory in (database_common.Cursor, database_common.CompactCursor):
+        with benchmark_cursor(cursor_factory) as cursor:
+            gc.collect()
+            tracemalloc.start()
+            started = time.perf_counter()
+            cursor.execute(ROWS_QUERY, {"rows": rows})
+            fetched = cursor.fetchall()
+            seconds = time.perf_counter() - started
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del fetched
+            results.append((cursor_factory.__name__, retained, peak, seconds))
+    return results
@@ -0,0 +1,29 @@
+# Probabilistic set used to answer "definitely not registered" without a database query.
+# A miss is certain, a hit may be a false positive and has to be confirmed by the database.
+import hashlib
+import math
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(
+            digest[8:], "big"
+        )
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(value)
+        )
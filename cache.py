@@ -0,0 +1,253 @@
+# Read-through cache in front of selected data_manager getters.
+# Results are pickled into an LRU where every entry expires after the TTL of its function, so callers never share
+# (and mutate) the same objects. By default every worker process keeps its own LRU; with CACHE_BACKEND_ADDRESS set
+# the workers share one LRU served by a local process (python cache.py), so an invalidation is seen by all of them.
+# An invalidation only reaches the LRU of the worker that wrote, so with the in-process LRU entries live at most
+# CACHE_LOCAL_TTL seconds, which bounds how long other workers serve stale rows.
+# The write functions of data_manager invalidate the exact entries they make stale.
+import collections
+import functools
+import logging
+import multiprocessing.managers
+import os
+import pickle
+import threading
+import time
+
+import database_common
+import routing
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 300))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+CACHE_LOCAL_TTL = float(os.environ.get("CACHE_LOCAL_TTL", 5))
+# host:port of the shared cache process, the in-process LRU is used when it is not set
+CACHE_BACKEND_ADDRESS = os.environ.get("CACHE_BACKEND_ADDRESS")
+
+# errors of an unreachable shared backend, the cache is then bypassed instead of failing the request
+BACKEND_ERRORS = (OSError, EOFError, multiprocessing.managers.RemoteError)
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+_errors = 0
+
+
+class LRUCache:
+    """Thread safe LRU of pickled values, each one expiring after its own TTL."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key: (expiry time, pickled value), least recently used first
+        self._entries = collections.OrderedDict()
+        # bumped by every invalidation, a value loaded across an invalidation may be stale
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    def lookup(self, key):
+        """Returns (pickled value or None, generation to pass to store on a miss)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None, self._generation
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1], self._generation
+
+    def store(self, key, value, ttl, generation):
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+            return True
+
+    def delete(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def status(self):
+        with self._lock:
+            status = dict(self.stats)
+            status.update(
+                {"entries": len(self._entries), "max_entries": self.max_entries}
+            )
+        return status
+
+
+class CacheManager(multiprocessing.managers.BaseManager):
+    pass
+
+
+def get_authkey():
+    authkey = os.environ.get("CACHE_BACKEND_AUTHKEY") or os.environ.get("SECRET_KEY")
+    if not authkey:
+        raise KeyError("CACHE_BACKEND_AUTHKEY (or SECRET_KEY) must be set")
+    return authkey.encode()
+
+
+def get_address():
+    host, port = CACHE_BACKEND_ADDRESS.rsplit(":", 1)
+    return host, int(port)
+
+
+def connect_backend():
+    CacheManager.register("get_cache")
+    manager = CacheManager(address=get_address(), authkey=get_authkey())
+    manager.connect()
+    return manager.get_cache()
+
+
+def get_backend():
+    # every (forked) worker process gets its own LRU or its own connection to the shared one
+    global _backend, _backend_pid
+    backend = _backend
+    if backend is None or _backend_pid != os.getpid():
+        with _backend_lock:
+            if _backend is None or _backend_pid != os.getpid():
+                _backend = connect_backend() if CACHE_BACKEND_ADDRESS else LRUCache()
+                _backend_pid = os.getpid()
+            backend = _backend
+    return backend
+
+
+def _count_error(action):
+    global _backend, _errors
+    _errors += 1
+    logger.warning("cache backend unavailable, could not %s", action, exc_info=True)
+    # a broken connection to the shared cache is reopened by the next call
+    with _backend_lock:
+        if CACHE_BACKEND_ADDRESS:
+            _backend = None
+
+
+def normalize(value):
+    # ids come as ints from the database and as strings from URLs, both must give the same key
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        if str(int(value)) == value:
+            return int(value)
+    return value
+
+
+def make_key(name, args, kwargs):
+    return (
+        (name,)
+        + tuple(normalize(arg) for arg in args)
+        + tuple(sorted((key, normalize(value)) for key, value in kwargs.items()))
+    )
+
+
+def get_ttl(ttl):
+    return ttl if CACHE_BACKEND_ADDRESS else min(ttl, CACHE_LOCAL_TTL)
+
+
+def cached(ttl=CACHE_TTL):
+    """Caches the (non None) results of the decorated function by its arguments for ttl seconds"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = make_key(function.__name__, args, kwargs)
+            try:
+                backend = get_backend()
+                value, generation = backend.lookup(key)
+            except BACKEND_ERRORS:
+                _count_error("look up " + function.__name__)
+                return function(*args, **kwargs)
+            if value is not None:
+                return pickle.loads(value)
+            # a lagging replica would fill the cache with rows older than the last invalidation
+            with routing.primary():
+                result = function(*args, **kwargs)
+            # rows read inside a unit of work may not be committed yet
+            if result is not None and not database_common.in_unit_of_work():
+                try:
+                    backend.store(
+                        key,
+                        pickle.dumps(result, pickle.HIGHEST_PROTOCOL),
+                        get_ttl(ttl),
+                        generation,
+                    )
+                except BACKEND_ERRORS:
+                    _count_error("store " + function.__name__)
+            return result
+
+        # the key of a call, for invalidate(); calls are keyed by their exact arguments
+        wrapper.cache_key = lambda *args, **kwargs: make_key(
+            function.__name__, args, kwargs
+        )
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*keys):
+    # inside a unit of work the rows change on commit, a read in between would cache the old ones again
+    database_common.on_commit(lambda: _delete(keys))
+
+
+def _delete(keys):
+    try:
+        get_backend().delete(list(keys))
+    except BACKEND_ERRORS:
+        _count_error("invalidate %s" % ", ".join(key[0] for key in keys))
+
+
+def clear():
+    try:
+        get_backend().clear()
+    except BACKEND_ERRORS:
+        _count_error("clear the cache")
+
+
+def status():
+    """Returns the hit/miss/eviction counters of the cache used by this process"""
+    try:
+        status = get_backend().status()
+    except BACKEND_ERRORS:
+        _count_error("read the cache status")
+        status = {}
+    status.update(
+        {"backend": "shared" if CACHE_BACKEND_ADDRESS else "local", "errors": _errors}
+    )
+    return status
+
+
+def serve():
+    """Serves one LRU shared by the workers at CACHE_BACKEND_ADDRESS"""
+    store = LRUCache()
+    CacheManager.register("get_cache", callable=lambda: store)
+    manager = CacheManager(address=get_address(), authkey=get_authkey())
+    logger.info("serving the shared cache on %s", CACHE_BACKEND_ADDRESS)
+    manager.get_server().serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not CACHE_BACKEND_ADDRESS:
+        raise SystemExit("CACHE_BACKEND_ADDRESS is not set")
+    serve()
@@ -1,5 +1,13 @@
+import os
+
+import cache
 import database_common
 
+# seconds a cached tag index is trusted, bounds staleness from writes the cache cannot see
+TAG_INDEX_TTL = float(os.environ.get("TAG_INDEX_TTL", 60))
+# newest matching questions and answers ranked by a search, bounds the ranking work of very common terms
+SEARCH_CANDIDATES = int(os.environ.get("SEARCH_CANDIDATES", 1000))
+
 
 @database_common.connection_handler
 def add_user(cursor, data):
@@ -10,21 +18,12 @@ def add_user(cursor, data):
 
 
 @database_common.connection_handler
-def add_user_vote_status(cursor, data):
+def update_user_password(cursor, user_id, password):
     query = """
-        INSERT INTO user_vote_status
-        VALUES %(data)s"""
-    cursor.execute(query, {"data": data})
-
-
-@database_common.connection_handler
-def get_vote_status(cursor, selected_page_id, page_id):
-    query = f"""
-        SELECT id,  {page_id} as page_id
-        FROM user_vote_status
-        WHERE {selected_page_id} = %(page_id)s"""
-    cursor.execute(query, {"selected_page_id": selected_page_id, "page_id": page_id})
-    return cursor.fetchall()
+        UPDATE user_account
+        SET password = %(password)s
+        WHERE id = %(user_id)s"""
+    cursor.execute(query, {"user_id": user_id, "password": password})
 
 
 @database_common.connection_handler
@@ -36,160 +35,342 @@ def update_reputation(cursor, user_id, value):
     cursor.execute(query, {"user_id": user_id, "value": value})
 
 
-@database_common.connection_handler
-def get_users_table(cursor):
-    query = """
-        WITH counting_questions as (
-            SELECT user_id,
-                   count(*) AS number_questions
-            FROM question
-            GROUP BY user_id
-            ),
-             counting_answers as (
-                SELECT  user_id,
-                       count(*) as number_answers
-                FROM answer
-                GROUP BY user_id
-                ),
-             counting_comments as (
-                 SELECT user_id,
-                        count(*) as number_comments
-                 FROM comment
-                 GROUP BY user_id
-             )
+@database_common.connection_handler(compact=True)
+def get_users_table(
+    cursor,
+    order_by="registration_date",
+    order_dir="ASC",
+    limit=None,
+    after=None,
+    before=None,
+):
+    order_columns = {
+        "user_name": "user_account.user_name",
+        "registration_date": "user_account.registration_date",
+        "questions": "user_stats.questions",
+        "answers": "user_stats.answers",
+        "comments": "user_stats.comments",
+        "reputation": "user_account.reputation",
+    }
+    if order_by in order_columns and order_dir.upper() in ["ASC", "DESC"]:
+        keyset, order, params = get_keyset(
+            order_columns[order_by],
+            "user_account.id",
+            "user_account JOIN user_stats ON user_stats.user_id = user_account.id",
+            order_dir.upper(),
+            after,
+            before,
+        )
+        query = f"""
+            SELECT id,
+                   user_name,
+                   email_address,
+                   registration_date,
+                   user_stats.questions,
+                   user_stats.answers,
+                   user_stats.comments,
+                   reputation
+            FROM user_account
+            JOIN user_stats ON user_stats.user_id = user_account.id
+            WHERE {keyset}
+            ORDER BY {order}
+            LIMIT %(limit)s"""
+        cursor.execute(query, dict(params, limit=limit))
+        users = cursor.fetchall()
+        return users[::-1] if before is not None else users
+
+
+GET_USER = database_common.prepared_statement(
+    "get_user",
+    """
         SELECT id,
                user_name,
                email_address,
                registration_date,
-               coalesce(counting_questions.number_questions, 0) as questions,
-               coalesce(counting_answers.number_answers, 0) as answers,
-               coalesce(counting_comments.number_comments, 0) as comments,
+               user_stats.questions,
+               user_stats.answers,
+               user_stats.comments,
                reputation
         FROM user_account
-        LEFT JOIN counting_questions ON user_account.id = counting_questions.user_id
-        LEFT join counting_answers ON user_account.id = counting_answers.user_id
-        LEFT join counting_comments on user_account.id = counting_comments.user_id
-        ORDER BY registration_date"""
-    cursor.execute(query)
-    return cursor.fetchall()
+        JOIN user_stats ON user_stats.user_id = user_account.id
+        WHERE id = %(user_id)s""",
+)
 
 
 @database_common.connection_handler
-def get_user_questions(cursor, user_id):
+def get_user(cursor, user_id):
+    cursor.execute(GET_USER, {"user_id": user_id})
+    return cursor.fetchone()
+
+
+@database_common.connection_handler
+def rebuild_user_stats(cursor):
     query = """
-        SELECT id, title
+        SELECT rebuild_user_stats() AS repaired"""
+    cursor.execute(query)
+    return cursor.fetchone()["repaired"]
+
+
+GET_USER_QUESTIONS = database_common.prepared_statement(
+    "get_user_questions",
+    """
+        SELECT id, title, is_solved
         FROM question
         WHERE user_id = %(user_id)s
-        ORDER BY submission_time"""
-    cursor.execute(query, {"user_id": user_id})
-    return cursor.fetchall()
+        ORDER BY submission_time""",
+)
 
 
 @database_common.connection_handler
-def get_accepted_status_by_question_id(cursor, question_id):
-    query = """
-        SELECT accepted_status
-        FROM answer
-        WHERE question_id = %(question_id)s"""
-    cursor.execute(query, {"question_id": question_id})
+def get_user_questions(cursor, user_id):
+    cursor.execute(GET_USER_QUESTIONS, {"user_id": user_id})
     return cursor.fetchall()
 
 
-@database_common.connection_handler
-def get_user_answers(cursor, user_id):
-    query = """
+GET_USER_ANSWERS = database_common.prepared_statement(
+    "get_user_answers",
+    """
         SELECT id, question_id, message, accepted_status
         FROM answer
         WHERE user_id = %(user_id)s
-        ORDER BY submission_time"""
-    cursor.execute(query, {"user_id": user_id})
+        ORDER BY submission_time""",
+)
+
+
+@database_common.connection_handler
+def get_user_answers(cursor, user_id):
+    cursor.execute(GET_USER_ANSWERS, {"user_id": user_id})
     return cursor.fetchall()
 
 
+GET_USER_COMMENTS = database_common.prepared_statement(
+    "get_user_comments",
+    """
+        SELECT comment.id, comment.question_id, comment.answer_id, comment.message,
+               answer.question_id AS answer_question_id
+        FROM comment
+        LEFT JOIN answer ON answer.id = comment.answer_id
+        WHERE comment.user_id = %(user_id)s
+        ORDER BY comment.submission_time""",
+)
+
+
 @database_common.connection_handler
 def get_user_comments(cursor, user_id):
-    query = """
-        SELECT id, question_id, answer_id, message
-        FROM comment
-        WHERE user_id = %(user_id)s
-        ORDER BY submission_time"""
-    cursor.execute(query, {"user_id": user_id})
+    cursor.execute(GET_USER_COMMENTS, {"user_id": user_id})
     return cursor.fetchall()
 
 
+IS_EMAIL_REGISTERED = database_common.prepared_statement(
+    "is_email_registered",
+    """
+        SELECT EXISTS (SELECT 1 FROM user_account WHERE email_address = %(email)s) AS registered""",
+)
+
+
 @database_common.connection_handler
-def get_user_emails(cursor):
-    query = """
-        SELECT email_address
-        FROM user_account"""
-    cursor.execute(query)
-    return cursor.fetchall()
+def is_email_registered(cursor, email):
+    cursor.execute(IS_EMAIL_REGISTERED, {"email": email})
+    return cursor.fetchone()["registered"]
+
+
+IS_USER_NAME_TAKEN = database_common.prepared_statement(
+    "is_user_name_taken",
+    """
+        SELECT EXISTS (SELECT 1 FROM user_account WHERE user_name = %(user_name)s) AS taken""",
+)
 
 
 @database_common.connection_handler
-def get_user_names(cursor):
+def is_user_name_taken(cursor, user_name):
+    cursor.execute(IS_USER_NAME_TAKEN, {"user_name": user_name})
+    return cursor.fetchone()["taken"]
+
+
+@database_common.connection_handler
+def get_user_identities(cursor):
     query = """
-        SELECT user_name
+        SELECT email_address, user_name
         FROM user_account"""
     cursor.execute(query)
     return cursor.fetchall()
 
 
-@database_common.connection_handler
-def get_username(cursor, email):
-    query = """
-        SELECT user_name
+GET_USER_BY_EMAIL = database_common.prepared_statement(
+    "get_user_by_email",
+    """
+        SELECT id, user_name
         FROM user_account
-        WHERE email_address = %(email)s"""
-    cursor.execute(query, {"email": email})
+        WHERE email_address = %(email)s""",
+)
+
+
+@database_common.connection_handler(memo=True)
+def get_user_by_email(cursor, email):
+    cursor.execute(GET_USER_BY_EMAIL, {"email": email})
     return cursor.fetchone()
 
 
-@database_common.connection_handler
-def get_user_pass(cursor, username):
-    query = """
-        SELECT password
+GET_USER_CREDENTIALS = database_common.prepared_statement(
+    "get_user_credentials",
+    """
+        SELECT id, user_name, password
         FROM user_account
-        WHERE email_address = %(username)s"""
-    cursor.execute(query, {"username": username})
-    return cursor.fetchone()
+        WHERE email_address = %(email)s""",
+)
 
 
 @database_common.connection_handler
-def get_user_id(cursor, email):
-    query = """
-        SELECT id
-        FROM user_account
-        WHERE email_address = %(email)s"""
-    cursor.execute(query, {"email": email})
+def get_user_credentials(cursor, email):
+    cursor.execute(GET_USER_CREDENTIALS, {"email": email})
     return cursor.fetchone()
 
 
-@database_common.connection_handler
-def get_all_questions(cursor, order_by="submission_time", order_dir="DESC"):
+def get_keyset(order_column, id_column, table, order_dir, after=None, before=None):
+    """Returns the WHERE condition, ORDER BY clause and parameters of a page after/before the row with a given id"""
+    # the cursor holds only the id, the sort value of that row is read back from table,
+    # so the page links stay short whatever the column holds
+    # pages before the cursor are read in reverse order, the caller flips them back
+    if before is not None:
+        order_dir = "ASC" if order_dir == "DESC" else "DESC"
+    position = before if before is not None else after
+    condition = "TRUE"
+    if position is not None:
+        comparison = ">" if order_dir == "ASC" else "<"
+        condition = f"""({order_column}, {id_column}) {comparison} (
+            SELECT {order_column}, {id_column} FROM {table} WHERE {id_column} = %(keyset_id)s
+        )"""
+    order = f"{order_column} {order_dir}, {id_column} {order_dir}"
+    return condition, order, {"keyset_id": position}
+
+
+@database_common.connection_handler(compact=True)
+def get_all_questions(
+    cursor,
+    order_by="submission_time",
+    order_dir="DESC",
+    limit=None,
+    after=None,
+    before=None,
+):
+    # after/before are the ids of the rows a page starts after/ends before, id breaks ties between equal values
     if (
         order_by
         in ["title", "submission_time", "message", "view_number", "vote_number"]
     ) and (order_dir.upper() in ["ASC", "DESC"]):
+        keyset, order, params = get_keyset(
+            order_by, "id", "question", order_dir.upper(), after, before
+        )
         query = f"""
-            SELECT *
+            SELECT id, submission_time, view_number, vote_number, user_id, title, message, image,
+                   answer_count, is_solved
             FROM question
-            ORDER BY {order_by} {order_dir.upper()}"""
-        cursor.execute(query)
-        return cursor.fetchall()
+            WHERE {keyset}
+            ORDER BY {order}
+            LIMIT %(limit)s"""
+        cursor.execute(query, dict(params, limit=limit))
+        questions = cursor.fetchall()
+        return questions[::-1] if before is not None else questions
+
+
+GET_QUESTION = database_common.prepared_statement(
+    "get_question",
+    """
+        SELECT id, submission_time, view_number, vote_number, user_id, title, message, image
+        FROM question
+        WHERE id = %(question_id)s""",
+)
 
 
+@cache.cached()
 @database_common.connection_handler
 def get_question(cursor, question_id):
-    query = """
-        SELECT *
-        FROM question
-        WHERE id = %(question_id)s"""
-    cursor.execute(query, {"question_id": question_id})
+    cursor.execute(GET_QUESTION, {"question_id": question_id})
     return cursor.fetchone()
 
 
-@database_common.connection_handler
+GET_QUESTION_THREAD = database_common.prepared_statement(
+    "get_question_thread",
+    """
+        SELECT question.id, question.submission_time, question.view_number, question.vote_number,
+               question.user_id, question.title, question.message, question.image,
+               user_account.user_name,
+               coalesce(question.user_id = %(current_user_id)s, FALSE) AS is_owner,
+               coalesce(
+                   (SELECT json_agg(json_build_object('id', tag.id, 'name', tag.name) ORDER BY tag.name)
+                    FROM question_tag
+                    JOIN tag ON tag.id = question_tag.tag_id
+                    WHERE question_tag.question_id = question.id),
+                   '[]'
+               ) AS tags
+        FROM question
+        LEFT JOIN user_account ON user_account.id = question.user_id
+        WHERE question.id = %(question_id)s""",
+)
+
+
+GET_QUESTION_THREAD_POSTS = database_common.prepared_statement(
+    "get_question_thread_posts",
+    """
+        SELECT *
+        FROM (
+            SELECT 'answer' AS kind, answer.id, NULL::integer AS answer_id, answer.user_id,
+                   user_account.user_name, answer.message, answer.submission_time,
+                   answer.vote_number, answer.accepted_status, answer.image,
+                   NULL::integer AS edited_count,
+                   coalesce(answer.user_id = %(current_user_id)s, FALSE) AS is_owner
+            FROM answer
+            LEFT JOIN user_account ON user_account.id = answer.user_id
+            WHERE answer.question_id = %(question_id)s
+            UNION ALL
+            SELECT 'comment', comment.id, NULL, comment.user_id,
+                   user_account.user_name, comment.message, comment.submission_time,
+                   NULL, NULL, NULL, comment.edited_count,
+                   coalesce(comment.user_id = %(current_user_id)s, FALSE)
+            FROM comment
+            LEFT JOIN user_account ON user_account.id = comment.user_id
+            WHERE comment.question_id = %(question_id)s
+            UNION ALL
+            SELECT 'comment', comment.id, comment.answer_id, comment.user_id,
+                   user_account.user_name, comment.message, comment.submission_time,
+                   NULL, NULL, NULL, comment.edited_count,
+                   coalesce(comment.user_id = %(current_user_id)s, FALSE)
+            FROM comment
+            JOIN answer ON answer.id = comment.answer_id
+            LEFT JOIN user_account ON user_account.id = comment.user_id
+            WHERE answer.question_id = %(question_id)s
+        ) AS thread
+        ORDER BY kind,
+                 CASE WHEN kind = 'answer' THEN submission_time END DESC,
+                 submission_time""",
+)
+
+
+@database_common.connection_handler
+def get_question_thread(cursor, question_id, current_user_id=None):
+    params = {"question_id": question_id, "current_user_id": current_user_id}
+    cursor.execute(GET_QUESTION_THREAD, params)
+    question = cursor.fetchone()
+    if question is None:
+        return None
+
+    cursor.execute(GET_QUESTION_THREAD_POSTS, params)
+
+    question["comments"] = []
+    answers = {}
+    for row in cursor.fetchall():
+        if row["kind"] == "answer":
+            row["comments"] = []
+            answers[row["id"]] = row
+        elif row["answer_id"] is None:
+            question["comments"].append(row)
+        else:
+            answers[row["answer_id"]]["comments"].append(row)
+    question["answers"] = list(answers.values())
+    return question
+
+
+@database_common.connection_handler(memo=True)
 def get_question_img(cursor, question_id):
     query = """
         SELECT image
@@ -199,7 +380,7 @@ def get_question_img(cursor, question_id):
     return cursor.fetchall()
 
 
-@database_common.connection_handler
+@database_common.connection_handler(memo=True)
 def get_question_id_by_answer_id(cursor, answer_id):
     query = """
         SELECT question_id
@@ -209,7 +390,7 @@ def get_question_id_by_answer_id(cursor, answer_id):
     return cursor.fetchone()
 
 
-@database_common.connection_handler
+@database_common.connection_handler(memo=True)
 def get_question_id_by_comment_id(cursor, comment_id):
     query = """
         SELECT question_id
@@ -219,7 +400,7 @@ def get_question_id_by_comment_id(cursor, comment_id):
     return cursor.fetchone()
 
 
-@database_common.connection_handler
+@database_common.connection_handler(memo=True)
 def get_answer_id_by_comment_id(cursor, comment_id):
     query = """
         SELECT answer_id
@@ -229,27 +410,6 @@ def get_answer_id_by_comment_id(cursor, comment_id):
     return cursor.fetchone()
 
 
-@database_common.connection_handler
-def get_all_answers(cursor):
-    query = """
-        SELECT *
-        FROM answer
-        ORDER BY submission_time DESC"""
-    cursor.execute(query)
-    return cursor.fetchall()
-
-
-@database_common.connection_handler
-def get_answers_by_question_id(cursor, question_id):
-    query = """
-        SELECT *
-        FROM answer
-        WHERE question_id = %(question_id)s
-        ORDER BY submission_time DESC"""
-    cursor.execute(query, {"question_id": question_id})
-    return cursor.fetchall()
-
-
 @database_common.connection_handler
 def get_answers_img_by_question_id(cursor, question_id):
     query = """
@@ -260,7 +420,7 @@ def get_answers_img_by_question_id(cursor, question_id):
     return cursor.fetchall()
 
 
-@database_common.connection_handler
+@database_common.connection_handler(memo=True)
 def get_answer_img(cursor, answer_id):
     query = """
         SELECT image
@@ -274,38 +434,36 @@ def get_answer_img(cursor, answer_id):
 def add_answer(cursor, data):
     query = """
         INSERT INTO answer (submission_time, vote_number, accepted_status, question_id, user_id, message, image)
-        VALUES %(data)s"""
+        VALUES %(data)s
+        RETURNING id"""
     cursor.execute(query, {"data": data})
+    return cursor.fetchone()["id"]
 
 
 @database_common.connection_handler
 def update_accepted_status(cursor, answer_id, status):
+    # returns the id of the answer's owner, None for an unknown answer
     query = """
         UPDATE answer
         SET accepted_status = %(status)s
-        WHERE id = %(answer_id)s"""
+        WHERE id = %(answer_id)s
+        RETURNING user_id"""
     cursor.execute(query, {"answer_id": answer_id, "status": status})
+    answer = cursor.fetchone()
+    return answer["user_id"] if answer else None
 
 
 @database_common.connection_handler
 def add_question(cursor, data):
     query = """
         INSERT INTO question (submission_time, view_number, vote_number, user_id, title, message, image)
-        VALUES %(data)s"""
+        VALUES %(data)s
+        RETURNING id"""
     cursor.execute(query, {"data": data})
+    return cursor.fetchone()["id"]
 
 
-@database_common.connection_handler
-def get_tag_by_name(cursor, name):
-    query = """
-        SELECT id 
-        FROM tag
-        WHERE name = %(name)s
-    """
-    cursor.execute(query, {"name": name})
-    return cursor.fetchone()
-
-
+@cache.cached()
 @database_common.connection_handler
 def get_all_tags(cursor):
     query = """
@@ -315,6 +473,7 @@ def get_all_tags(cursor):
     return cursor.fetchall()
 
 
+@cache.cached()
 @database_common.connection_handler
 def get_question_tags(cursor, question_id):
     query = """
@@ -326,28 +485,86 @@ def get_question_tags(cursor, question_id):
     return cursor.fetchall()
 
 
+@cache.cached(ttl=TAG_INDEX_TTL)
 @database_common.connection_handler
-def get_questions_by_tag(cursor, tag):
-    tag_id = get_tag_by_name(tag)["id"]
+def get_tag_index(cursor):
+    # every tag with its question count
     query = """
-        SELECT id, title
-        FROM question
-        WHERE id IN (SELECT question_id FROM question_tag WHERE tag_id = %(tag_id)s)
-        ORDER BY submission_time
-    """
-    cursor.execute(query, {"tag_id": tag_id})
+        SELECT tag.id, tag.name, count(question_tag.question_id) AS question_count
+        FROM tag
+        LEFT JOIN question_tag ON question_tag.tag_id = tag.id
+        GROUP BY tag.id
+        ORDER BY tag.id"""
+    cursor.execute(query)
     return cursor.fetchall()
 
 
+@database_common.connection_handler(compact=True)
+def get_questions_by_tag(cursor, tag, limit=None, after=None, before=None):
+    keyset, order, params = get_keyset(
+        "question.submission_time", "question.id", "question", "ASC", after, before
+    )
+    query = f"""
+        SELECT question.id, question.title, question.submission_time, question.is_solved
+        FROM question
+        JOIN question_tag ON question_tag.question_id = question.id
+        JOIN tag ON tag.id = question_tag.tag_id
+        WHERE tag.name = %(tag)s AND {keyset}
+        ORDER BY {order}
+        LIMIT %(limit)s"""
+    cursor.execute(query, dict(params, tag=tag, limit=limit))
+    questions = cursor.fetchall()
+    return questions[::-1] if before is not None else questions
+
+
 @database_common.connection_handler
-def count_question_answers(cursor, question_id=None):
+def rebuild_question_counters(cursor):
     query = """
-        SELECT COUNT(id) 
-        FROM answer
-        WHERE question_id = %(question_id)s
+        SELECT rebuild_question_counters() AS repaired"""
+    cursor.execute(query)
+    return cursor.fetchone()["repaired"]
+
+
+GET_QUESTIONS_TAGS = database_common.prepared_statement(
+    "get_questions_tags",
     """
-    cursor.execute(query, {"question_id": question_id})
-    return cursor.fetchone()
+        SELECT question_tag.question_id, tag.id, tag.name
+        FROM question_tag
+        JOIN tag ON tag.id = question_tag.tag_id
+        WHERE question_tag.question_id = ANY(%(question_ids)s)
+        ORDER BY tag.name""",
+)
+
+
+GET_QUESTIONS_AUTHORS = database_common.prepared_statement(
+    "get_questions_authors",
+    """
+        SELECT question.id, user_account.user_name
+        FROM question
+        JOIN user_account ON user_account.id = question.user_id
+        WHERE question.id = ANY(%(question_ids)s)""",
+)
+
+
+@database_common.connection_handler
+def get_questions_view_data(cursor, question_ids):
+    view_data = {
+        question_id: {"tags": [], "user_name": None} for question_id in question_ids
+    }
+    if not view_data:
+        return view_data
+
+    cursor.execute(GET_QUESTIONS_TAGS, {"question_ids": list(view_data)})
+    for row in cursor.fetchall():
+        view_data[row["question_id"]]["tags"].append(
+            {"id": row["id"], "name": row["name"]}
+        )
+
+    cursor.execute(GET_QUESTIONS_AUTHORS, {"question_ids": list(view_data)})
+    for row in cursor.fetchall():
+        view_data[row["id"]]["user_name"] = row["user_name"]
+
+    return view_data
 
 
 @database_common.connection_handler
@@ -355,18 +572,25 @@ def add_tag(cursor, name):
     query = """
         INSERT INTO tag (name)
         VALUES (%(name)s)
+        ON CONFLICT (name) DO NOTHING
     """
     cursor.execute(query, {"name": name})
+    cache.invalidate(get_all_tags.cache_key(), get_tag_index.cache_key())
 
 
 @database_common.connection_handler
 def add_tag_to_question(cursor, tag_name, question_id):
-    tag_id = get_tag_by_name(tag_name)["id"]
     query = """
-        INSERT INTO question_tag
-        VALUES (%s, %s)
+        INSERT INTO question_tag (question_id, tag_id)
+        SELECT %(question_id)s, id
+        FROM tag
+        WHERE name = %(tag_name)s
+        ON CONFLICT DO NOTHING
     """
-    cursor.execute(query, (question_id, tag_id))
+    cursor.execute(query, {"question_id": question_id, "tag_name": tag_name})
+    cache.invalidate(
+        get_question_tags.cache_key(question_id), get_tag_index.cache_key()
+    )
 
 
 @database_common.connection_handler
@@ -376,72 +600,40 @@ def delete_tag_from_question(cursor, question_id, tag_id):
         WHERE tag_id=%(tag_id)s AND question_id=%(question_id)s
     """
     cursor.execute(query, {"tag_id": tag_id, "question_id": question_id})
+    cache.invalidate(
+        get_question_tags.cache_key(question_id), get_tag_index.cache_key()
+    )
 
 
 @database_common.connection_handler
 def add_comment(cursor, data):
     query = """
         INSERT INTO comment (question_id, answer_id, user_id, message, submission_time, edited_count)
-        VALUES %(data)s"""
+        VALUES %(data)s
+        RETURNING id"""
     cursor.execute(query, {"data": data})
+    return cursor.fetchone()["id"]
 
 
 @database_common.connection_handler
-def get_new_question_id(cursor):
-    query = """
-        SELECT max(id) as new_id
-        FROM question"""
-    cursor.execute(query)
-    return cursor.fetchone()
-
-
-@database_common.connection_handler
-def get_user_id_by_question_id(cursor, question_id):
-    query = """
-        SELECT user_id
-        FROM question
-        WHERE id = %(question_id)s"""
-    cursor.execute(query, {"question_id": question_id})
-    return cursor.fetchone()
-
-
-@database_common.connection_handler
-def get_user_name_by_user_id(cursor, user_id):
-    query = """
-        SELECT user_name
-        FROM user_account
-        WHERE id = %(user_id)s"""
-    cursor.execute(query, {"user_id": user_id})
-    return cursor.fetchone()
-
-
-@database_common.connection_handler
-def get_user_id_by_answer_id(cursor, answer_id):
-    query = """
-        SELECT user_id
-        FROM answer
-        WHERE id = %(answer_id)s"""
-    cursor.execute(query, {"answer_id": answer_id})
-    return cursor.fetchone()
-
-
-@database_common.connection_handler
-def get_user_id_by_comment_id(cursor, comment_id):
-    query = """
-        SELECT user_id
-        FROM comment
-        WHERE id = %(comment_id)s"""
-    cursor.execute(query, {"comment_id": comment_id})
-    return cursor.fetchone()
-
-
-@database_common.connection_handler
-def update_views(cursor, question_id):
+def add_views(cursor, views):
+    # views maps question ids to the number of views to add
+    question_ids = sorted(views)
     query = """
         UPDATE question
-        SET view_number = view_number + 1
-        WHERE id = %(question_id)s"""
-    cursor.execute(query, {"question_id": question_id})
+        SET view_number = view_number + views.count
+        FROM unnest(%(question_ids)s::integer[], %(counts)s::integer[]) AS views(id, count)
+        WHERE question.id = views.id"""
+    cursor.execute(
+        query,
+        {
+            "question_ids": question_ids,
+            "counts": [views[question_id] for question_id in question_ids],
+        },
+    )
+    cache.invalidate(
+        *[get_question.cache_key(question_id) for question_id in question_ids]
+    )
 
 
 @database_common.connection_handler
@@ -459,6 +651,7 @@ def update_question(cursor, question_id, title, message, image):
             "image": image,
         },
     )
+    cache.invalidate(get_question.cache_key(question_id))
 
 
 @database_common.connection_handler
@@ -475,6 +668,11 @@ def delete_question(cursor, question_id):
         DELETE FROM question
         WHERE id = %(question_id)s"""
     cursor.execute(query, {"question_id": question_id})
+    cache.invalidate(
+        get_question.cache_key(question_id),
+        get_question_tags.cache_key(question_id),
+        get_tag_index.cache_key(),
+    )
 
 
 @database_common.connection_handler
@@ -495,54 +693,93 @@ def delete_comment(cursor, comment_id):
     cursor.execute(query, {"comment_id": comment_id})
 
 
-@database_common.connection_handler
-def vote_question(cursor, question_id, value):
-    query = """
-        UPDATE question
-        SET vote_number = vote_number + %(value)s
-        WHERE id = %(question_id)s"""
-    cursor.execute(query, {"question_id": question_id, "value": value})
-
-
-@database_common.connection_handler
-def vote_answer(cursor, answer_id, value):
-    query = """
-        UPDATE answer
-        SET vote_number = vote_number + %(value)s
-        WHERE id = %(answer_id)s"""
-    cursor.execute(query, {"answer_id": answer_id, "value": value})
-
-
-@database_common.connection_handler
-def get_question_comments(cursor, question_id):
-    query = """
-        SELECT id, user_id, message, submission_time, edited_count
-        FROM comment
-        WHERE question_id = %(question_id)s
-        ORDER BY submission_time"""
-    cursor.execute(query, {"question_id": question_id})
-    return cursor.fetchall()
-
-
-@database_common.connection_handler
-def get_answer_comments(cursor, answer_id=None):
-    query = """
-        SELECT id, user_id, message, submission_time, edited_count
-        FROM comment
-        WHERE answer_id = %(answer_id)s
-        ORDER BY submission_time"""
-    cursor.execute(query, {"answer_id": answer_id})
-    return cursor.fetchall()
+# a single statement: the ballot insert is rejected by the unique index on a repeated vote,
+# and only a recorded ballot changes the vote number and the owner's reputation
+VOTE_QUESTION = database_common.prepared_statement(
+    "vote_question",
+    """
+        WITH ballot AS (
+            INSERT INTO user_vote_status (id, question_id)
+            SELECT %(user_id)s, question.id::text
+            FROM question
+            WHERE question.id = %(question_id)s AND question.user_id <> %(user_id)s
+            ON CONFLICT DO NOTHING
+            RETURNING question_id
+        ),
+        voted AS (
+            UPDATE question
+            SET vote_number = vote_number + %(value)s
+            WHERE id IN (SELECT question_id::integer FROM ballot)
+            RETURNING user_id
+        ),
+        owner AS (
+            UPDATE user_account
+            SET reputation = reputation + %(reputation)s
+            FROM voted
+            WHERE user_account.id = voted.user_id
+        )
+        SELECT count(*) > 0 AS counted
+        FROM voted""",
+)
+
+
+@database_common.connection_handler
+def vote_question(cursor, question_id, user_id, value, reputation):
+    cursor.execute(
+        VOTE_QUESTION,
+        {
+            "question_id": question_id,
+            "user_id": user_id,
+            "value": value,
+            "reputation": reputation,
+        },
+    )
+    counted = cursor.fetchone()["counted"]
+    if counted:
+        cache.invalidate(get_question.cache_key(question_id))
+    return counted
 
 
-@database_common.connection_handler
-def get_question_message(cursor, question_id):
-    query = """
-        SELECT message
-        FROM question
-        WHERE id = %(question_id)s"""
-    cursor.execute(query, {"question_id": question_id})
-    return cursor.fetchone()
+VOTE_ANSWER = database_common.prepared_statement(
+    "vote_answer",
+    """
+        WITH ballot AS (
+            INSERT INTO user_vote_status (id, answer_id)
+            SELECT %(user_id)s, answer.id::text
+            FROM answer
+            WHERE answer.id = %(answer_id)s AND answer.user_id <> %(user_id)s
+            ON CONFLICT DO NOTHING
+            RETURNING answer_id
+        ),
+        voted AS (
+            UPDATE answer
+            SET vote_number = vote_number + %(value)s
+            WHERE id IN (SELECT answer_id::integer FROM ballot)
+            RETURNING user_id
+        ),
+        owner AS (
+            UPDATE user_account
+            SET reputation = reputation + %(reputation)s
+            FROM voted
+            WHERE user_account.id = voted.user_id
+        )
+        SELECT count(*) > 0 AS counted
+        FROM voted""",
+)
+
+
+@database_common.connection_handler
+def vote_answer(cursor, answer_id, user_id, value, reputation):
+    cursor.execute(
+        VOTE_ANSWER,
+        {
+            "answer_id": answer_id,
+            "user_id": user_id,
+            "value": value,
+            "reputation": reputation,
+        },
+    )
+    return cursor.fetchone()["counted"]
 
 
 @database_common.connection_handler
@@ -609,23 +846,74 @@ def get_comment_edited_count(cursor, comment_id):
     return cursor.fetchone()
 
 
-@database_common.connection_handler
-def get_questions_with_phrase(cursor, phrase):
-    query = """
-        SELECT *
-        FROM question
-        WHERE title ILIKE %(phrase)s 
-        OR message ILIKE %(phrase)s
-        OR id IN(SELECT question_id FROM answer WHERE message ILIKE %(phrase)s)"""
-    cursor.execute(query, {"phrase": f"%{phrase}%"})
+@database_common.connection_handler(compact=True)
+def search_questions(cursor, phrase, limit, offset=0):
+    # questions matching through one of their answers rank below direct title/message matches,
+    # only the SEARCH_CANDIDATES newest matches of each table are ranked
+    query = """
+        WITH search AS (
+            SELECT websearch_to_tsquery('english', %(phrase)s) AS query
+        ),
+        question_candidates AS (
+            SELECT question.id, question.search_vector
+            FROM question, search
+            WHERE question.search_vector @@ search.query
+            ORDER BY question.id DESC
+            LIMIT %(candidates)s
+        ),
+        answer_candidates AS (
+            SELECT answer.question_id, answer.search_vector
+            FROM answer, search
+            WHERE answer.search_vector @@ search.query
+            ORDER BY answer.id DESC
+            LIMIT %(candidates)s
+        ),
+        matches AS (
+            SELECT id, ts_rank(search_vector, search.query) AS rank
+            FROM question_candidates, search
+            UNION ALL
+            SELECT question_id, ts_rank(search_vector, search.query) * 0.5
+            FROM answer_candidates, search
+        ),
+        ranked AS (
+            SELECT id, max(rank) AS rank
+            FROM matches
+            GROUP BY id
+            ORDER BY rank DESC, id DESC
+            LIMIT %(limit)s OFFSET %(offset)s
+        )
+        SELECT question.id, question.submission_time, question.view_number, question.vote_number,
+               question.user_id, question.title, question.message, question.image,
+               question.answer_count, question.is_solved,
+               ts_headline('english', coalesce(question.title, ''), search.query,
+                           'StartSel=<strong>, StopSel=</strong>, HighlightAll=TRUE') AS title_snippet,
+               ts_headline('english', coalesce(question.message, ''), search.query,
+                           'StartSel=<strong>, StopSel=</strong>, MaxFragments=2, MaxWords=35, MinWords=15') AS snippet
+        FROM ranked
+        JOIN question ON question.id = ranked.id
+        CROSS JOIN search
+        ORDER BY ranked.rank DESC, question.id DESC"""
+    cursor.execute(
+        query,
+        {
+            "phrase": phrase,
+            "limit": limit,
+            "offset": offset,
+            "candidates": SEARCH_CANDIDATES,
+        },
+    )
     return cursor.fetchall()
 
 
-@database_common.connection_handler
-def get_answers_with_message_by_question_ids(cursor, question_ids, phrase):
+@database_common.connection_handler(compact=True)
+def get_answer_snippets(cursor, question_ids, phrase):
     query = """
-        SELECT *
-        FROM answer
-        WHERE question_id IN %(question_ids)s AND message ILIKE %(phrase)s"""
-    cursor.execute(query, {"question_ids": question_ids, "phrase": f"%{phrase}%"})
+        SELECT answer.id, answer.question_id,
+               ts_headline('english', coalesce(answer.message, ''), search.query,
+                           'StartSel=<strong>, StopSel=</strong>, MaxFragments=2, MaxWords=35, MinWords=15') AS snippet
+        FROM answer, websearch_to_tsquery('english', %(phrase)s) AS search(query)
+        WHERE answer.question_id = ANY(%(question_ids)s)
+        AND answer.search_vector @@ search.query
+        ORDER BY answer.vote_number DESC, answer.id"""
+    cursor.execute(query, {"question_ids": list(question_ids), "phrase": phrase})
     return cursor.fetchall()
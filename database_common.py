@@ -1,9 +1,43 @@
 # Creates a decorator to handle the database connection/cursor opening/closing.
 # Creates the cursor with RealDictCursor, thus it returns real dictionaries, where the column names are the keys.
+# Functions returning large lists can ask for compact rows instead, tuples read like dictionaries (see Row).
+# Connections are borrowed from a per-process pool instead of being opened for every call.
+import contextlib
+import functools
+import logging
 import os
+import re
+import threading
+import time
 
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
+
+import metrics
+import profiler
+import request_memo
+import routing
+
+logger = logging.getLogger(__name__)
+
+POOL_MIN_SIZE = int(os.environ.get("PSQL_POOL_MIN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("PSQL_POOL_MAX_SIZE", 10))
+# seconds a caller waits for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get("PSQL_POOL_TIMEOUT", 10))
+# idle connections older than this are closed (as long as the pool stays above its min size)
+POOL_MAX_IDLE = float(os.environ.get("PSQL_POOL_MAX_IDLE", 300))
+# idle connections older than this are pinged before being handed out
+POOL_HEALTH_CHECK_AFTER = float(os.environ.get("PSQL_POOL_HEALTH_CHECK_AFTER", 30))
+
+# functions named like this only read, anything else may write
+READ_PREFIXES = ("get_", "is_", "search_")
+# set to 0 behind a pooler that does not keep sessions (e.g. pgbouncer in transaction mode)
+PREPARED_STATEMENTS_ENABLED = os.environ.get("PSQL_PREPARED_STATEMENTS", "1") != "0"
+# set to 0 to return dictionaries from the functions that opted in to compact rows
+COMPACT_ROWS_ENABLED = os.environ.get("PSQL_COMPACT_ROWS", "1") != "0"
+PLACEHOLDER = re.compile(r"%\((\w+)\)s")
 
 
 def get_connection_string():
@@ -28,10 +62,210 @@ def get_connection_string():
         raise KeyError("Some necessary environment variable(s) are not defined")
 
 
-def open_database():
+def get_replica_connection_string():
+    # the replica shares the credentials and database name of the primary, only the host differs
+    replica_host = os.environ.get("PSQL_REPLICA_HOST")
+    if not replica_host:
+        return None
+    return "postgresql://{user_name}:{password}@{host}/{database_name}".format(
+        user_name=os.environ.get("PSQL_USER_NAME"),
+        password=os.environ.get("PSQL_PASSWORD"),
+        host=replica_host,
+        database_name=os.environ.get("PSQL_DB_NAME"),
+    )
+
+
+class PreparedStatement:
+    """A query prepared once per connection and then executed by name"""
+
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+        # the %(name)s placeholders become $1, $2... in order of first appearance
+        self.params = []
+        self.statement = PLACEHOLDER.sub(self._number, query).replace("%%", "%")
+        placeholders = ", ".join(["%s"] * len(self.params))
+        self.execute_query = (
+            f"EXECUTE {name} ({placeholders})" if self.params else f"EXECUTE {name}"
+        )
+
+    def _number(self, match):
+        if match.group(1) not in self.params:
+            self.params.append(match.group(1))
+        return f"${self.params.index(match.group(1)) + 1}"
+
+    def __str__(self):
+        return self.query
+
+
+PREPARED_STATEMENTS = {}
+
+
+def prepared_statement(name, query):
+    """Registers a query to be prepared on every pooled connection, execute the result like a query string"""
+    if name in PREPARED_STATEMENTS:
+        raise ValueError(f"prepared statement {name} is already registered")
+    PREPARED_STATEMENTS[name] = PreparedStatement(name, query)
+    return PREPARED_STATEMENTS[name]
+
+
+class Connection(psycopg2.extensions.connection):
+    """Connection remembering the statements prepared in its session"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class PreparingCursor:
+    """Cursor mixin executing PreparedStatement queries, preparing them on first use"""
+
+    def prepare(self, statement):
+        if statement.name not in self.connection.prepared:
+            super().execute(f"PREPARE {statement.name} AS {statement.statement}")
+            self.connection.prepared.add(statement.name)
+
+    def execute(self, query, params=None):
+        if not isinstance(query, PreparedStatement):
+            return super().execute(query, params)
+        if not PREPARED_STATEMENTS_ENABLED:
+            return super().execute(query.query, params)
+        self.prepare(query)
+        try:
+            return super().execute(
+                query.execute_query, [params[name] for name in query.params]
+            )
+        except psycopg2.errors.InvalidSqlStatementName:
+            # the session lost its prepared statements, prepare again on the next call
+            self.connection.prepared.clear()
+            raise
+
+
+class Cursor(PreparingCursor, psycopg2.extras.RealDictCursor):
+    """RealDictCursor that also executes PreparedStatement queries"""
+
+
+class Row:
+    """Row of a CompactCursor: its values in a tuple and the column positions shared by every row of the result.
+    Reads like a dictionary or by attribute. Keys added after the fetch go to a dictionary of their own.
+    """
+
+    __slots__ = ("_positions", "_values", "_extra")
+
+    def __init__(self, positions, values):
+        self._positions = positions
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        position = self._positions.get(key)
+        if position is not None:
+            return self._values[position]
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        position = self._positions.get(key)
+        if position is not None:
+            # rows are written a few times at most, rebuilding the tuple keeps them small
+            values = self._values
+            self._values = values[:position] + (value,) + values[position + 1 :]
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __getattr__(self, name):
+        # unset slots and special names (looked up by copy and pickle) are never columns
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, key):
+        return key in self._positions or (
+            self._extra is not None and key in self._extra
+        )
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._values) + (len(self._extra) if self._extra else 0)
+
+    def __eq__(self, other):
+        if isinstance(other, (Row, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Row({dict(self.items())!r})"
+
+    def keys(self):
+        return list(self._positions) + (list(self._extra) if self._extra else [])
+
+    def values(self):
+        return list(self._values) + (list(self._extra.values()) if self._extra else [])
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, other=(), **kwargs):
+        for key, value in dict(other, **kwargs).items():
+            self[key] = value
+
+
+class CompactCursor(PreparingCursor, psycopg2.extensions.cursor):
+    """Cursor returning Row objects, far smaller than the RealDictCursor rows on large results"""
+
+    _positions = None
+
+    def execute(self, query, params=None):
+        self._positions = None
+        return super().execute(query, params)
+
+    def _make_rows(self, rows):
+        if self._positions is None:
+            self._positions = {
+                column.name: index for index, column in enumerate(self.description)
+            }
+        return [Row(self._positions, row) for row in rows]
+
+    def fetchone(self):
+        row = super().fetchone()
+        return None if row is None else self._make_rows([row])[0]
+
+    def fetchmany(self, size=None):
+        return self._make_rows(
+            super().fetchmany(self.arraysize if size is None else size)
+        )
+
+    def fetchall(self):
+        return self._make_rows(super().fetchall())
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+
+def open_database(connection_string=None):
     try:
-        connection_string = get_connection_string()
-        connection = psycopg2.connect(connection_string)
+        connection_string = connection_string or get_connection_string()
+        connection = psycopg2.connect(connection_string, connection_factory=Connection)
         connection.autocommit = True
     except psycopg2.DatabaseError as exception:
         print("Database connection problem")
@@ -39,14 +273,374 @@ def open_database():
     return connection
 
 
-def connection_handler(function):
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+class ConnectionPool:
+    """Thread safe pool of autocommit connections with health checks and idle recycling."""
+
+    def __init__(
+        self,
+        connection_string,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        timeout=POOL_TIMEOUT,
+        max_idle=POOL_MAX_IDLE,
+        health_check_after=POOL_HEALTH_CHECK_AFTER,
+    ):
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self.pid = os.getpid()
+        # (connection, time it was returned) pairs, most recently returned last
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.stats = {
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "borrowed": 0,
+            "returned": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "failed_health_checks": 0,
+            "max_in_use": 0,
+        }
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        # the caller has already reserved a slot in self._size
+        try:
+            connection = open_database(self.connection_string)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.stats["connections_created"] += 1
+        return connection
+
+    def _discard(self, connection):
+        self._size -= 1
+        self.stats["connections_discarded"] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _recycle_idle(self, now):
+        while self._idle and self._size > self.min_size:
+            connection, returned_at = self._idle[0]
+            if now - returned_at < self.max_idle:
+                break
+            self._idle.pop(0)
+            self._discard(connection)
+
+    def _is_healthy(self, connection, returned_at):
+        if connection.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            self.stats["failed_health_checks"] += 1
+            return False
+
+    def _acquire(self, started):
+        # returns (connection, returned_at) for an idle connection or (None, None) for a reserved new slot
+        deadline = started + self.timeout
+        waited = False
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                now = time.monotonic()
+                self._recycle_idle(now)
+                if self._idle:
+                    self._count_borrow(len(self._idle) - 1)
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    self._count_borrow(len(self._idle))
+                    return None, None
+                remaining = deadline - now
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    logger.warning(
+                        "connection pool exhausted (%s connections in use)", self._size
+                    )
+                    raise PoolTimeout(
+                        "no database connection available within %ss" % self.timeout
+                    )
+                if not waited:
+                    waited = True
+                    self.stats["waits"] += 1
+                self._condition.wait(remaining)
+                self.stats["wait_seconds"] += time.monotonic() - now
+
+    def _count_borrow(self, idle_after):
+        self.stats["borrowed"] += 1
+        in_use = self._size - idle_after
+        if in_use > self.stats["max_in_use"]:
+            self.stats["max_in_use"] = in_use
+        logger.debug("borrowed connection, %s/%s in use", in_use, self.max_size)
+
+    def getconn(self):
+        started = time.monotonic()
+        while True:
+            connection, returned_at = self._acquire(started)
+            if connection is None:
+                return self._connect()
+            # health checks run outside the lock so a slow ping does not stall other borrowers
+            if self._is_healthy(connection, returned_at):
+                return connection
+            with self._condition:
+                self.stats["borrowed"] -= 1
+                self._discard(connection)
+                self._condition.notify()
+
+    def putconn(self, connection):
+        with self._condition:
+            self.stats["returned"] += 1
+            if self._closed or connection.closed or not self._reset(connection):
+                self._discard(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @staticmethod
+    def _reset(connection):
+        # a connection left inside a (failed) transaction must not leak into the next borrower
+        try:
+            if (
+                connection.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            ):
+                connection.rollback()
+            connection.autocommit = True
+            return True
+        except psycopg2.Error:
+            return False
+
+    def closeall(self):
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._discard(connection)
+            self._condition.notify_all()
+
+    def status(self):
+        with self._condition:
+            status = dict(self.stats)
+            status.update(
+                {
+                    "size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle),
+                    "min_size": self.min_size,
+                    "max_size": self.max_size,
+                }
+            )
+        return status
+
+
+# "primary" and, with PSQL_REPLICA_HOST set, "replica" pools
+_pools = {}
+_pool_lock = threading.Lock()
+# pools inherited through fork are kept alive but never used: closing (or garbage collecting)
+# their connections would terminate the parent's sessions over the shared sockets
+_inherited_pools = []
+
+
+def get_pool(role="primary"):
+    # every (forked) worker process gets its own pools, sockets are never shared between processes
+    pool = _pools.get(role)
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pools.get(role)
+            if pool is None or pool.pid != os.getpid():
+                if pool is not None:
+                    _inherited_pools.append(pool)
+                connection_string = (
+                    get_replica_connection_string()
+                    if role == "replica"
+                    else get_connection_string()
+                )
+                pool = _pools[role] = ConnectionPool(connection_string)
+    return pool
+
+
+def close_pool():
+    with _pool_lock:
+        for pool in _pools.values():
+            if pool.pid == os.getpid():
+                pool.closeall()
+        _pools.clear()
+
+
+def pool_status(role="primary"):
+    pool = _pools.get(role)
+    if pool is None or pool.pid != os.getpid():
+        return None
+    return pool.status()
+
+
+def get_roles():
+    return (
+        ["primary", "replica"] if os.environ.get("PSQL_REPLICA_HOST") else ["primary"]
+    )
+
+
+def prepare_statements():
+    """Prepares the registered statements on the connections this worker keeps open"""
+    if not PREPARED_STATEMENTS_ENABLED:
+        return
+    for role in get_roles():
+        connections = []
+        try:
+            pool = get_pool(role)
+            for _ in range(pool.min_size):
+                connections.append(pool.getconn())
+        except (psycopg2.OperationalError, psycopg2.pool.PoolError):
+            if role == "primary":
+                raise
+            # the worker still starts, its reads fall back to the primary until the replica is back
+            logger.warning(
+                "replica unavailable, statements not prepared", exc_info=True
+            )
+            for connection in connections:
+                pool.putconn(connection)
+            continue
+        try:
+            for connection in connections:
+                with connection.cursor(cursor_factory=Cursor) as cursor:
+                    for statement in PREPARED_STATEMENTS.values():
+                        cursor.prepare(statement)
+        finally:
+            for connection in connections:
+                pool.putconn(connection)
+
+
+def is_read(function):
+    return function.__name__.startswith(READ_PREFIXES)
+
+
+def get_connection(read):
+    """Returns (pool, connection), from the replica for a read that may use it, else from the primary"""
+    if read and os.environ.get("PSQL_REPLICA_HOST") and routing.may_use_replica():
+        try:
+            # creating the pool opens its first connections, a replica that is down fails here
+            pool = get_pool("replica")
+            return pool, pool.getconn()
+        except (psycopg2.OperationalError, psycopg2.pool.PoolError):
+            logger.warning(
+                "replica unavailable, reading from the primary", exc_info=True
+            )
+    pool = get_pool()
+    return pool, pool.getconn()
+
+
+_unit_of_work = threading.local()
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    """Runs every data_manager call made inside the block on one primary connection, in one transaction"""
+    # nested blocks join the outermost one, which commits when it exits and rolls back on an error
+    if in_unit_of_work():
+        yield
+        return
+    profile = profiler.get_profile()
+    started = time.perf_counter()
+    pool = get_pool()
+    connection = pool.getconn()
+    if profile is not None:
+        profile.add_connection(time.perf_counter() - started)
+    _unit_of_work.connection, _unit_of_work.callbacks = connection, []
+    try:
+        connection.autocommit = False
+        yield
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        callbacks = _unit_of_work.callbacks
+        _unit_of_work.connection, _unit_of_work.callbacks = None, []
+        pool.putconn(connection)
+    for callback in callbacks:
+        callback()
+
+
+def in_unit_of_work():
+    return getattr(_unit_of_work, "connection", None) is not None
+
+
+def on_commit(callback):
+    """Calls callback once the current unit of work is committed, or right away outside of one"""
+    if in_unit_of_work():
+        _unit_of_work.callbacks.append(callback)
+    else:
+        callback()
+
+
+def connection_handler(function=None, compact=False, memo=False):
+    """Runs function with a cursor, compact=True makes the cursor return Row objects instead of dictionaries
+    and memo=True lets a read answer identical calls of the same request from the request memo
+    """
+    if function is None:
+        return functools.partial(connection_handler, compact=compact, memo=memo)
+    read = is_read(function)
+    memoized = memo and read
+    cursor_factory = CompactCursor if compact and COMPACT_ROWS_ENABLED else Cursor
+
+    @functools.wraps(function)
     def wrapper(*args, **kwargs):
-        connection = open_database()
-        # we set the cursor_factory parameter to return with a RealDictCursor cursor (cursor which provide dictionaries)
-        dict_cur = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        ret_value = function(dict_cur, *args, **kwargs)
-        dict_cur.close()
-        connection.close()
-        return ret_value
+        request_results = request_memo.get_memo()
+        if request_results is not None:
+            if memoized:
+                return request_results.call(function.__name__, run, args, kwargs)
+            if not read:
+                request_results.clear()
+        if not read:
+            routing.record_write()
+        return run(*args, **kwargs)
+
+    def run(*args, **kwargs):
+        profile = profiler.get_profile()
+        started = time.perf_counter()
+        # inside a unit of work every call shares its connection and transaction
+        connection = getattr(_unit_of_work, "connection", None)
+        pool = None
+        if connection is None:
+            pool, connection = get_connection(read)
+            if profile is not None:
+                profile.add_connection(time.perf_counter() - started)
+        try:
+            # we set the cursor_factory parameter to return with a RealDictCursor cursor (cursor which provide dictionaries)
+            # or, for the functions that asked for compact rows, with a CompactCursor
+            with connection.cursor(cursor_factory=cursor_factory) as dict_cur:
+                if profile is not None:
+                    dict_cur = profiler.ProfilingCursor(
+                        dict_cur, profile, function.__name__
+                    )
+                return function(dict_cur, *args, **kwargs)
+        finally:
+            if pool is not None:
+                pool.putconn(connection)
+            metrics.observe_db_call(function.__name__, time.perf_counter() - started)
 
     return wrapper
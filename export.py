@@ -0,0 +1,184 @@
+# Streams the forum tables out as NDJSON or CSV through named (server-side) cursors.
+# Rows are fetched and encoded one batch at a time, so memory stays bounded by the batch size whatever the table size.
+# Tables are walked in key order: an export can resume after the last exported key, and every batch written to a file
+# is followed by a checkpoint (last key, file size) next to it. Gzipped batches are separate gzip members,
+# which concatenate into a valid gzip file, so a file can be cut back to its last checkpoint and appended to.
+import csv
+import gzip
+import io
+import json
+import os
+
+import database_common
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 2000))
+FORMATS = ["ndjson", "csv"]
+
+# table: (columns, key columns), in dependency order so that every table comes after the ones it references
+TABLES = {
+    "user_account": (
+        [
+            "id",
+            "user_name",
+            "email_address",
+            "registration_date",
+            "password",
+            "reputation",
+        ],
+        ["id"],
+    ),
+    "question": (
+        [
+            "id",
+            "submission_time",
+            "view_number",
+            "vote_number",
+            "user_id",
+            "title",
+            "message",
+            "image",
+        ],
+        ["id"],
+    ),
+    "answer": (
+        [
+            "id",
+            "submission_time",
+            "vote_number",
+            "accepted_status",
+            "question_id",
+            "user_id",
+            "message",
+            "image",
+        ],
+        ["id"],
+    ),
+    "comment": (
+        [
+            "id",
+            "question_id",
+            "answer_id",
+            "user_id",
+            "message",
+            "submission_time",
+            "edited_count",
+        ],
+        ["id"],
+    ),
+    "tag": (["id", "name"], ["id"]),
+    "question_tag": (["question_id", "tag_id"], ["question_id", "tag_id"]),
+}
+# tables whose keys are not integers, user ids are varchar
+TEXT_KEYS = {"user_account"}
+
+
+def iter_batches(table, after=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yields the rows of table following the key after, in key order, batch_size rows at a time"""
+    columns, key = TABLES[table]
+    condition = "TRUE"
+    if after is not None:
+        placeholders = ", ".join(["%s"] * len(key))
+        condition = f"({', '.join(key)}) > ({placeholders})"
+    # table and column names come from TABLES, never from the caller
+    query = f"""
+        SELECT {', '.join(columns)}
+        FROM {table}
+        WHERE {condition}
+        ORDER BY {', '.join(key)}"""
+    pool, connection = database_common.get_connection(read=True)
+    try:
+        # named cursors live in a transaction, the rows stay on the server until fetched
+        connection.autocommit = False
+        with connection.cursor(name=f"export_{table}") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, list(after) if after is not None else None)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [dict(zip(columns, row)) for row in rows]
+    finally:
+        pool.putconn(connection)
+
+
+def get_key(table, row):
+    return [row[column] for column in TABLES[table][1]]
+
+
+def parse_key(table, value):
+    """Parses a comma separated key, as given to the export endpoint"""
+    parts = value.split(",")
+    if len(parts) != len(TABLES[table][1]):
+        raise ValueError(f"{table} keys have {len(TABLES[table][1])} part(s)")
+    if table in TEXT_KEYS:
+        return parts
+    return [int(part) for part in parts]
+
+
+def encode_batch(table, rows, export_format, header=False, compress=False):
+    if export_format == "ndjson":
+        data = "".join(json.dumps(row, default=str) + "\n" for row in rows)
+    else:
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=TABLES[table][0])
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+        data = output.getvalue()
+    data = data.encode()
+    return gzip.compress(data) if compress else data
+
+
+def stream(table, export_format, after=None, compress=False):
+    """Yields the encoded export of table chunk by chunk, for a streamed response"""
+    header = after is None
+    batches = iter_batches(table, after)
+    try:
+        for rows in batches:
+            yield encode_batch(table, rows, export_format, header, compress)
+            header = False
+        if header and export_format == "csv":
+            # an empty CSV export still names its columns
+            yield encode_batch(table, [], export_format, header, compress)
+    finally:
+        batches.close()
+
+
+def get_path(directory, table, export_format, compress):
+    return os.path.join(
+        directory, f"{table}.{export_format}" + (".gz" if compress else "")
+    )
+
+
+def export_table(directory, table, export_format, compress=False, resume=False):
+    """Exports table into directory and returns the number of rows written"""
+    path = get_path(directory, table, export_format, compress)
+    checkpoint_path = path + ".checkpoint"
+    after, offset = None, 0
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        after, offset = checkpoint["after"], checkpoint["offset"]
+    elif os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    exported = 0
+    with open(path, "r+b" if offset else "wb") as file:
+        # drop whatever was written after the last checkpoint
+        file.truncate(offset)
+        file.seek(offset)
+        for rows in iter_batches(table, after):
+            file.write(encode_batch(table, rows, export_format, offset == 0, compress))
+            file.flush()
+            os.fsync(file.fileno())
+            offset, after = file.tell(), get_key(table, rows[-1])
+            exported += len(rows)
+            write_checkpoint(checkpoint_path, after, offset)
+        if offset == 0 and export_format == "csv":
+            file.write(encode_batch(table, [], export_format, True, compress))
+    return exported
+
+
+def write_checkpoint(path, after, offset):
+    with open(path + ".tmp", "w") as file:
+        json.dump({"after": after, "offset": offset}, file)
+    os.replace(path + ".tmp", path)
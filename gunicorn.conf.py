@@ -0,0 +1,40 @@
+# Pre-forking production server settings, every value can be overridden with an environment variable.
+# The app is imported once by the master, each worker then opens its own connection pool
+# (nothing is shared through fork) and warms up before serving. Password hashing is limited host-wide,
+# see passwords.py.
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("WEB_THREADS", 1))
+preload_app = True
+# seconds a stopping worker gets to finish its in-flight requests
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 30))
+keepalive = 5
+# restart workers now and then, with jitter so they do not all restart at once
+max_requests = int(os.environ.get("MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
+
+
+def on_starting(arbiter):
+    import metrics
+
+    # counters saved by the workers of a previous run would be merged into this one
+    if metrics.METRICS_DIR:
+        metrics.clear_saved()
+
+
+def post_worker_init(worker):
+    import server
+
+    server.warmup()
+    worker.log.info("worker %s warmed up", worker.pid)
+
+
+def worker_exit(arbiter, worker):
+    import server
+
+    server.shutdown()
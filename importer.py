@@ -0,0 +1,232 @@
+# Bulk imports NDJSON or CSV dumps (the files written by `flask export`) with COPY.
+# Every file is copied into a temporary staging table, then merged with one INSERT ... SELECT per table:
+# imported posts and tags get new ids from the table sequences, tags are matched by name and users by email address,
+# and every reference is remapped through the (old id, new id) tables built along the way.
+# The whole import is one transaction. The per-row counter triggers are disabled while it runs and the counters
+# are rebuilt once at the end, which needs the importing role to own the tables and locks them until the commit.
+import csv
+import gzip
+import os
+
+import cache
+import database_common
+import export
+
+COPY_BUFFER_SIZE = int(os.environ.get("IMPORT_COPY_BUFFER_SIZE", 1 << 20))
+
+# in merge order, every table is imported after the ones it references
+TABLES = {
+    "user_account": export.TABLES["user_account"][0],
+    "tag": export.TABLES["tag"][0],
+    "question": export.TABLES["question"][0],
+    "answer": export.TABLES["answer"][0],
+    "comment": export.TABLES["comment"][0],
+    "question_tag": export.TABLES["question_tag"][0],
+}
+# table: triggers replaced by the rebuild at the end of the import
+TRIGGERS = {
+    "user_account": ["user_account_user_stats"],
+    "question": ["question_user_stats"],
+    "answer": ["answer_question_counters", "answer_user_stats"],
+    "comment": ["comment_user_stats"],
+}
+
+# (old id, new id) of every imported row, a primary key on old_id rejects duplicated ids in a dump
+MAPPINGS = {
+    "user_account": """
+        CREATE TEMP TABLE user_ids ON COMMIT DROP AS
+        SELECT staged.id AS old_id,
+               coalesce(
+                   registered.id,
+                   CASE WHEN taken.id IS NULL THEN staged.id ELSE left(md5(random()::text || staged.id), 12) END
+               ) AS new_id,
+               registered.id IS NULL AS is_new
+        FROM import_user_account AS staged
+        LEFT JOIN user_account AS registered ON registered.email_address = staged.email_address
+        LEFT JOIN user_account AS taken ON taken.id = staged.id;
+        ALTER TABLE user_ids ADD PRIMARY KEY (old_id)""",
+    "tag": """
+        INSERT INTO tag (name)
+        SELECT DISTINCT name FROM import_tag
+        ON CONFLICT (name) DO NOTHING;
+        CREATE TEMP TABLE tag_ids ON COMMIT DROP AS
+        SELECT import_tag.id AS old_id, tag.id AS new_id
+        FROM import_tag
+        JOIN tag ON tag.name = import_tag.name;
+        ALTER TABLE tag_ids ADD PRIMARY KEY (old_id)""",
+    "question": """
+        CREATE TEMP TABLE question_ids ON COMMIT DROP AS
+        SELECT id AS old_id, nextval(pg_get_serial_sequence('question', 'id')) AS new_id
+        FROM import_question;
+        ALTER TABLE question_ids ADD PRIMARY KEY (old_id)""",
+    "answer": """
+        CREATE TEMP TABLE answer_ids ON COMMIT DROP AS
+        SELECT id AS old_id, nextval(pg_get_serial_sequence('answer', 'id')) AS new_id
+        FROM import_answer;
+        ALTER TABLE answer_ids ADD PRIMARY KEY (old_id)""",
+}
+
+# posts of users missing from the dump keep their user id, posts whose question or answer is missing are skipped
+MERGES = {
+    "user_account": """
+        INSERT INTO user_account (id, user_name, email_address, registration_date, password, reputation)
+        SELECT user_ids.new_id,
+               CASE WHEN EXISTS (SELECT 1 FROM user_account WHERE user_name = staged.user_name)
+                    THEN staged.user_name || '_' || left(user_ids.new_id, 6)
+                    ELSE staged.user_name END,
+               staged.email_address, staged.registration_date, staged.password, coalesce(staged.reputation, 0)
+        FROM import_user_account AS staged
+        JOIN user_ids ON user_ids.old_id = staged.id
+        WHERE user_ids.is_new""",
+    "tag": None,
+    "question": """
+        INSERT INTO question (id, submission_time, view_number, vote_number, user_id, title, message, image)
+        SELECT question_ids.new_id, staged.submission_time, coalesce(staged.view_number, 0),
+               coalesce(staged.vote_number, 0), coalesce(user_ids.new_id, staged.user_id), staged.title,
+               staged.message, staged.image
+        FROM import_question AS staged
+        JOIN question_ids ON question_ids.old_id = staged.id
+        LEFT JOIN user_ids ON user_ids.old_id = staged.user_id""",
+    "answer": """
+        INSERT INTO answer (id, submission_time, vote_number, accepted_status, question_id, user_id, message, image)
+        SELECT answer_ids.new_id, staged.submission_time, coalesce(staged.vote_number, 0),
+               staged.accepted_status, question_ids.new_id, coalesce(user_ids.new_id, staged.user_id),
+               staged.message, staged.image
+        FROM import_answer AS staged
+        JOIN answer_ids ON answer_ids.old_id = staged.id
+        JOIN question_ids ON question_ids.old_id = staged.question_id
+        LEFT JOIN user_ids ON user_ids.old_id = staged.user_id""",
+    "comment": """
+        INSERT INTO comment (question_id, answer_id, user_id, message, submission_time, edited_count)
+        SELECT question_ids.new_id, answer_ids.new_id, coalesce(user_ids.new_id, staged.user_id),
+               staged.message, staged.submission_time, coalesce(staged.edited_count, 0)
+        FROM import_comment AS staged
+        LEFT JOIN question_ids ON question_ids.old_id = staged.question_id
+        LEFT JOIN answer_ids ON answer_ids.old_id = staged.answer_id
+        LEFT JOIN user_ids ON user_ids.old_id = staged.user_id
+        WHERE (staged.question_id IS NULL OR question_ids.new_id IS NOT NULL)
+        AND (staged.answer_id IS NULL OR answer_ids.new_id IS NOT NULL)""",
+    "question_tag": """
+        INSERT INTO question_tag (question_id, tag_id)
+        SELECT question_ids.new_id, tag_ids.new_id
+        FROM import_question_tag AS staged
+        JOIN question_ids ON question_ids.old_id = staged.question_id
+        JOIN tag_ids ON tag_ids.old_id = staged.tag_id
+        ON CONFLICT DO NOTHING""",
+}
+# mapping tables the merges join, created empty when their dump is missing
+EMPTY_MAPPINGS = {
+    "user_account": "CREATE TEMP TABLE user_ids (old_id varchar PRIMARY KEY, new_id varchar, is_new boolean) ON COMMIT DROP",
+    "tag": "CREATE TEMP TABLE tag_ids (old_id integer PRIMARY KEY, new_id integer) ON COMMIT DROP",
+    "question": "CREATE TEMP TABLE question_ids (old_id integer PRIMARY KEY, new_id integer) ON COMMIT DROP",
+    "answer": "CREATE TEMP TABLE answer_ids (old_id integer PRIMARY KEY, new_id integer) ON COMMIT DROP",
+}
+
+
+def find_dump(directory, table):
+    """Returns (path, format, compressed) of the dump of table in directory, None when there is none"""
+    for export_format in export.FORMATS:
+        for compress in (False, True):
+            path = export.get_path(directory, table, export_format, compress)
+            if os.path.exists(path):
+                return path, export_format, compress
+    return None
+
+
+def open_dump(path, compress):
+    return gzip.open(path, "rb") if compress else open(path, "rb")
+
+
+def read_header(table, file):
+    """Reads the CSV header line of file, the columns COPY fills in that order"""
+    header = next(csv.reader([file.readline().decode()]), [])
+    unknown = set(header) - set(TABLES[table])
+    if unknown or not header:
+        raise ValueError(
+            f"{table}: unexpected CSV columns {', '.join(sorted(unknown))}"
+        )
+    return header
+
+
+def copy_dump(cursor, table, path, export_format, compress):
+    """Copies the dump of table into its staging table and returns the number of staged rows"""
+    # table and column names come from TABLES, never from the dump
+    with open_dump(path, compress) as file:
+        if export_format == "csv":
+            columns = read_header(table, file)
+            cursor.copy_expert(
+                f"COPY import_{table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                file,
+                COPY_BUFFER_SIZE,
+            )
+        else:
+            # one JSON document per line, quote and delimiter bytes never occur in JSON text
+            cursor.copy_expert(
+                "COPY import_documents (document) FROM STDIN "
+                "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')",
+                file,
+                COPY_BUFFER_SIZE,
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO import_{table}
+                SELECT record.*
+                FROM import_documents, jsonb_populate_record(NULL::import_{table}, document) AS record
+                WHERE document IS NOT NULL;
+                TRUNCATE import_documents"""
+            )
+    cursor.execute(f"ANALYZE import_{table}")
+    cursor.execute(f"SELECT count(*) FROM import_{table}")
+    return cursor.fetchone()[0]
+
+
+def import_dumps(directory):
+    """Imports the dumps found in directory and returns {table: (staged rows, imported rows)}"""
+    dumps = {table: find_dump(directory, table) for table in TABLES}
+    if not any(dumps.values()):
+        raise FileNotFoundError(f"no dump found in {directory}")
+    results = {}
+    pool = database_common.get_pool()
+    connection = pool.getconn()
+    try:
+        connection.autocommit = False
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TABLE import_documents (document jsonb) ON COMMIT DROP"
+            )
+            for table, triggers in TRIGGERS.items():
+                for trigger in triggers:
+                    cursor.execute(f"ALTER TABLE {table} DISABLE TRIGGER {trigger}")
+            for table, columns in TABLES.items():
+                if dumps[table] is None:
+                    if table in EMPTY_MAPPINGS:
+                        cursor.execute(EMPTY_MAPPINGS[table])
+                    continue
+                cursor.execute(
+                    f"""
+                    CREATE TEMP TABLE import_{table} ON COMMIT DROP AS
+                    SELECT {', '.join(columns)} FROM {table} WITH NO DATA"""
+                )
+                staged = copy_dump(cursor, table, *dumps[table])
+                if table in MAPPINGS:
+                    cursor.execute(MAPPINGS[table])
+                if MERGES[table] is None:
+                    cursor.execute("SELECT count(*) FROM tag_ids")
+                    imported = cursor.fetchone()[0]
+                else:
+                    cursor.execute(MERGES[table])
+                    imported = cursor.rowcount
+                results[table] = (staged, imported)
+            for table, triggers in TRIGGERS.items():
+                for trigger in triggers:
+                    cursor.execute(f"ALTER TABLE {table} ENABLE TRIGGER {trigger}")
+            cursor.execute("SELECT rebuild_question_counters()")
+            cursor.execute("SELECT rebuild_user_stats()")
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        pool.putconn(connection)
+    cache.clear()
+    return results
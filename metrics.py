@@ -0,0 +1,247 @@
+# Request, database, pool and cache metrics in the Prometheus text exposition format.
+# Every worker process aggregates its own samples in memory. With METRICS_DIR set it also saves them to
+# METRICS_DIR/<pid>.json (at most every METRICS_SAVE_INTERVAL seconds and when it exits), and a scrape served by
+# any worker merges the files of all of them: counters and histograms are summed, including those of workers that
+# have exited, gauges are summed over the live workers only.
+import glob
+import json
+import os
+import threading
+import time
+
+METRICS_DIR = os.environ.get("METRICS_DIR")
+METRICS_SAVE_INTERVAL = float(os.environ.get("METRICS_SAVE_INTERVAL", 1))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name: (type, help)
+DEFINITIONS = {
+    "askmate_http_requests_total": (
+        "counter",
+        "HTTP requests by route, method and status.",
+    ),
+    "askmate_http_request_duration_seconds": (
+        "histogram",
+        "HTTP request latency by route.",
+    ),
+    "askmate_http_requests_in_flight": ("gauge", "HTTP requests being served."),
+    "askmate_db_calls_total": ("counter", "data_manager calls by function."),
+    "askmate_db_seconds_total": (
+        "counter",
+        "Seconds spent in data_manager calls (connection checkout included) by function.",
+    ),
+    "askmate_db_pool_connections": ("gauge", "Pooled database connections by state."),
+    "askmate_db_pool_max_connections": (
+        "gauge",
+        "Maximum size of the connection pools.",
+    ),
+    "askmate_db_pool_waits_total": (
+        "counter",
+        "Checkouts that waited for a free connection.",
+    ),
+    "askmate_db_pool_timeouts_total": ("counter", "Checkouts that gave up waiting."),
+    "askmate_cache_requests_total": ("counter", "Cache lookups by result."),
+    "askmate_cache_evictions_total": ("counter", "Cache entries evicted to make room."),
+    "askmate_cache_hit_ratio": ("gauge", "Share of the cache lookups that were hits."),
+}
+
+# how the samples of several workers are merged
+SUM, LIVE, MAX = "sum", "live", "max"
+
+_lock = threading.Lock()
+_pid = None
+_counters = {}
+_histograms = {}
+_in_flight = 0
+_saved_at = 0.0
+# functions returning extra (name, labels, value, merge) samples when a snapshot is taken
+_collectors = []
+
+
+def _check_process():
+    # called with the lock held, a forked worker starts from empty counters
+    global _pid, _counters, _histograms, _in_flight, _saved_at
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _counters, _histograms, _in_flight, _saved_at = {}, {}, 0, 0.0
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, labels, value=1):
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, labels, value):
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        # one count per bucket (not cumulative) plus the +Inf bucket, then the sum
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                break
+        else:
+            index = len(LATENCY_BUCKETS)
+        histogram[index] += 1
+        histogram[-1] += value
+
+
+def request_started():
+    global _in_flight
+    with _lock:
+        _check_process()
+        _in_flight += 1
+
+
+def request_finished(route, method, status, seconds):
+    global _in_flight
+    with _lock:
+        _check_process()
+        _in_flight -= 1
+    inc(
+        "askmate_http_requests_total",
+        {"route": route, "method": method, "status": str(status)},
+    )
+    observe("askmate_http_request_duration_seconds", {"route": route}, seconds)
+    if METRICS_DIR and time.monotonic() - _saved_at > METRICS_SAVE_INTERVAL:
+        save()
+
+
+def observe_db_call(function_name, seconds):
+    labels = {"function": function_name}
+    inc("askmate_db_calls_total", labels)
+    inc("askmate_db_seconds_total", labels, seconds)
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+def snapshot():
+    """Returns the samples of this worker as [name, labels, value, merge] lists"""
+    with _lock:
+        _check_process()
+        counters, histograms, in_flight = (
+            dict(_counters),
+            {key: list(value) for key, value in _histograms.items()},
+            _in_flight,
+        )
+    samples = [
+        [name, dict(labels), value, SUM] for (name, labels), value in counters.items()
+    ]
+    for (name, labels), histogram in histograms.items():
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram):
+            cumulative += count
+            samples.append(
+                [name + "_bucket", dict(labels, le=str(bound)), cumulative, SUM]
+            )
+        samples.append([name + "_sum", dict(labels), histogram[-1], SUM])
+        samples.append([name + "_count", dict(labels), cumulative, SUM])
+    samples.append(["askmate_http_requests_in_flight", {}, in_flight, LIVE])
+    for collector in _collectors:
+        samples.extend(list(sample) for sample in collector())
+    return samples
+
+
+def save(samples=None):
+    global _saved_at
+    samples = snapshot() if samples is None else samples
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    # written aside and renamed, a scrape never reads a half written file
+    with open(path + ".tmp", "w") as file:
+        json.dump({"pid": os.getpid(), "samples": samples}, file)
+    os.replace(path + ".tmp", path)
+    _saved_at = time.monotonic()
+
+
+def clear_saved():
+    """Removes the files of a previous run, called by the server before it starts its workers"""
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        os.remove(path)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    """Returns {(name, labels): value} merged over every worker"""
+    samples = snapshot()
+    workers = [(os.getpid(), samples)]
+    if METRICS_DIR:
+        save(samples)
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            try:
+                with open(path) as file:
+                    saved = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if saved["pid"] != os.getpid():
+                workers.append((saved["pid"], saved["samples"]))
+    merged = {}
+    for pid, samples in workers:
+        alive = pid == os.getpid() or _is_alive(pid)
+        for name, labels, value, merge in samples:
+            if merge == LIVE and not alive:
+                continue
+            key = _key(name, labels)
+            if merge == MAX:
+                merged[key] = max(merged.get(key, value), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    hits = merged.get(_key("askmate_cache_requests_total", {"result": "hit"}), 0)
+    misses = merged.get(_key("askmate_cache_requests_total", {"result": "miss"}), 0)
+    if hits + misses:
+        merged[_key("askmate_cache_hit_ratio", {})] = hits / (hits + misses)
+    return merged
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in labels
+    )
+    return (
+        "{"
+        + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped))
+        + "}"
+    )
+
+
+def _family(name):
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[: -len(suffix)] in DEFINITIONS:
+            return name[: -len(suffix)]
+    return name
+
+
+def render():
+    """Returns every metric in the text exposition format"""
+    families = {}
+    for (name, labels), value in collect().items():
+        families.setdefault(_family(name), []).append((name, labels, value))
+    lines = []
+    for family, samples in families.items():
+        if family in DEFINITIONS:
+            kind, description = DEFINITIONS[family]
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+        for name, labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
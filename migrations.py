@@ -0,0 +1,64 @@
+# Applies the versioned SQL scripts of sample_data/migrations in order, each one exactly once.
+# Every script runs in its own transaction together with its schema_migrations bookkeeping row,
+# and an advisory lock keeps several workers starting at once from migrating concurrently.
+import os
+import re
+
+import database_common
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "sample_data", "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+# arbitrary key shared by every process running migrations
+ADVISORY_LOCK_KEY = 7263543
+
+
+def get_migrations():
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append(
+                (
+                    int(match.group(1)),
+                    match.group(2),
+                    os.path.join(MIGRATIONS_DIR, file_name),
+                )
+            )
+    return sorted(migrations)
+
+
+def get_applied_versions(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamp without time zone NOT NULL DEFAULT now()
+        )"""
+    )
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate():
+    """Applies the pending migrations and returns the (version, name) pairs applied"""
+    applied = []
+    pool = database_common.get_pool()
+    connection = pool.getconn()
+    try:
+        connection.autocommit = False
+        for version, name, path in get_migrations():
+            with connection, connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ADVISORY_LOCK_KEY,))
+                if version in get_applied_versions(cursor):
+                    continue
+                with open(path) as script:
+                    cursor.execute(script.read())
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+            applied.append((version, name))
+    finally:
+        pool.putconn(connection)
+    return applied
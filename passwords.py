@@ -0,0 +1,123 @@
+# Runs bcrypt hashing and verification, at most PASSWORD_WORKERS operations at once on the whole host.
+# The limit is a set of lock files shared by every web worker: an operation holds one of them while bcrypt runs,
+# and the kernel releases it even when the worker dies. An operation that cannot get a slot within
+# PASSWORD_QUEUE_TIMEOUT seconds, or is not done within PASSWORD_TIMEOUT seconds, fails with PasswordQueueFull.
+# A worker serving one request at a time hashes inline. With WEB_THREADS > 1 the work goes to a small process pool,
+# so the other request threads of the worker are not stalled by it.
+import contextlib
+import fcntl
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+# bcrypt operations running at once on the host, across every web worker
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 1))
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_QUEUE_TIMEOUT", 1))
+PASSWORD_TIMEOUT = float(os.environ.get("PASSWORD_TIMEOUT", 10))
+PASSWORD_SLOTS_DIR = os.environ.get(
+    "PASSWORD_SLOTS_DIR", os.path.join(tempfile.gettempdir(), "askmate-password-slots")
+)
+# request threads per web worker, as configured in gunicorn.conf.py
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 1))
+
+BCRYPT_COST = re.compile(r"^\$2[abxy]?\$(\d{2})\$")
+
+
+class PasswordQueueFull(Exception):
+    pass
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def slot():
+    """Holds one of the PASSWORD_WORKERS host-wide slots"""
+    os.makedirs(PASSWORD_SLOTS_DIR, exist_ok=True)
+    deadline = time.monotonic() + PASSWORD_QUEUE_TIMEOUT
+    while True:
+        for index in range(PASSWORD_WORKERS):
+            file = open(os.path.join(PASSWORD_SLOTS_DIR, f"{index}.lock"), "a")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            # closing the file releases the lock
+            with file:
+                yield
+            return
+        if time.monotonic() >= deadline:
+            raise PasswordQueueFull("too many password operations in progress")
+        time.sleep(0.01)
+
+
+def _hash(plain_text_password, rounds):
+    with slot():
+        return bcrypt.hashpw(
+            plain_text_password.encode("utf-8"), bcrypt.gensalt(rounds)
+        ).decode("utf-8")
+
+
+def _check(plain_text_password, hashed_password):
+    with slot():
+        return bcrypt.checkpw(
+            plain_text_password.encode("utf-8"), hashed_password.encode("utf-8")
+        )
+
+
+def get_executor():
+    """Returns the process pool of this worker, None when it hashes inline"""
+    # a forked web worker cannot use the process pool of its parent
+    global _executor, _executor_pid
+    if WEB_THREADS <= 1:
+        return None
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=min(WEB_THREADS, PASSWORD_WORKERS)
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+def _run(function, *args):
+    executor = get_executor()
+    if executor is None:
+        return function(*args)
+    future = executor.submit(function, *args)
+    try:
+        return future.result(PASSWORD_TIMEOUT)
+    except TimeoutError:
+        # a job still waiting for a process is dropped, a running one finishes unobserved
+        future.cancel()
+        raise PasswordQueueFull("password operation timed out") from None
+
+
+def hash_password(plain_text_password):
+    return _run(_hash, plain_text_password, BCRYPT_ROUNDS)
+
+
+def is_valid_password(plain_text_password, hashed_password):
+    return _run(_check, plain_text_password, hashed_password)
+
+
+def needs_rehash(hashed_password):
+    match = BCRYPT_COST.match(hashed_password)
+    return match is None or int(match.group(1)) != BCRYPT_ROUNDS
@@ -0,0 +1,140 @@
+# Per-request database profiler, fed by database_common.connection_handler.
+# Records every query (text, duration, calling function) and every connection borrowed from the pool while a
+# Flask request is handled, then reports the totals in a Server-Timing header and a JSON log line.
+# A query shape (the query text without literals) repeated more than QUERY_REPEAT_THRESHOLD times in one request
+# is logged as a warning, it usually means a loop issues one query per row (N+1).
+import collections
+import json
+import logging
+import os
+import re
+import time
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+PROFILER_ENABLED = os.environ.get("QUERY_PROFILER") == "1"
+PROFILER_TOOLBAR = os.environ.get("QUERY_PROFILER_TOOLBAR") == "1"
+QUERY_REPEAT_THRESHOLD = int(os.environ.get("QUERY_REPEAT_THRESHOLD", 5))
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+WHITESPACE = re.compile(r"\s+")
+
+
+class Profile:
+    def __init__(self):
+        # (function name, query text, seconds)
+        self.queries = []
+        self.connections = 0
+        self.connection_seconds = 0.0
+
+    def add_connection(self, seconds):
+        self.connections += 1
+        self.connection_seconds += seconds
+
+    def add_query(self, function_name, query, seconds):
+        self.queries.append((function_name, query, seconds))
+
+    @property
+    def query_seconds(self):
+        return sum(seconds for _, _, seconds in self.queries)
+
+    def shapes(self):
+        """Returns {query shape: (count, total seconds, calling function names)}, most repeated first"""
+        shapes = collections.OrderedDict()
+        for function_name, query, seconds in self.queries:
+            shape = get_shape(query)
+            count, total, functions = shapes.get(shape, (0, 0.0, set()))
+            functions.add(function_name)
+            shapes[shape] = (count + 1, total + seconds, functions)
+        return dict(sorted(shapes.items(), key=lambda item: -item[1][0]))
+
+    def repeated(self, threshold=QUERY_REPEAT_THRESHOLD):
+        return {
+            shape: stats
+            for shape, stats in self.shapes().items()
+            if stats[0] > threshold
+        }
+
+
+class ProfilingCursor:
+    """Wraps a cursor and times every statement it executes"""
+
+    def __init__(self, cursor, profile, function_name):
+        self.cursor = cursor
+        self.profile = profile
+        self.function_name = function_name
+
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self.cursor.execute(query, params)
+        finally:
+            self.profile.add_query(
+                self.function_name, query, time.perf_counter() - started
+            )
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def get_shape(query):
+    query = query.decode() if isinstance(query, bytes) else str(query)
+    return WHITESPACE.sub(" ", LITERALS.sub("?", query)).strip()
+
+
+def is_enabled():
+    return PROFILER_ENABLED or PROFILER_TOOLBAR or flask.current_app.debug
+
+
+def get_profile():
+    """Returns the profile of the current request, None outside of a request or when profiling is off"""
+    if not flask.has_request_context() or not is_enabled():
+        return None
+    if "profile" not in flask.g:
+        flask.g.profile = Profile()
+    return flask.g.profile
+
+
+def report(response):
+    """Adds the Server-Timing header to the response and logs the profile of the request"""
+    profile = flask.g.get("profile")
+    if profile is None:
+        return response
+    query_ms = profile.query_seconds * 1000
+    connection_ms = profile.connection_seconds * 1000
+    response.headers.add(
+        "Server-Timing",
+        f'db;dur={query_ms:.1f};desc="{len(profile.queries)} queries", '
+        f'db-connect;dur={connection_ms:.1f};desc="{profile.connections} connections"',
+    )
+    repeated = profile.repeated()
+    logger.info(
+        json.dumps(
+            {
+                "method": flask.request.method,
+                "path": flask.request.path,
+                "status": response.status_code,
+                "queries": len(profile.queries),
+                "query_ms": round(query_ms, 2),
+                "connections": profile.connections,
+                "connection_ms": round(connection_ms, 2),
+                "repeated_queries": [
+                    {"query": shape, "count": count, "ms": round(seconds * 1000, 2)}
+                    for shape, (count, seconds, _) in repeated.items()
+                ],
+            }
+        )
+    )
+    for shape, (count, seconds, functions) in repeated.items():
+        logger.warning(
+            "%s %s ran the same query %s times (%s, %.1f ms): %s",
+            flask.request.method,
+            flask.request.path,
+            count,
+            ", ".join(sorted(functions)),
+            seconds * 1000,
+            shape,
+        )
+    return response
@@ -0,0 +1,190 @@
+# Regression check for the query plans of the hot data_manager functions.
+# Seeds a large synthetic dataset inside a transaction, runs every hot function through a cursor
+# that EXPLAINs each statement before executing it, and reports sequential scans on the big tables.
+# The transaction is rolled back at the end, so the database is left untouched.
+import inspect
+import json
+
+import data_manager
+import database_common
+
+LARGE_TABLES = {
+    "question",
+    "answer",
+    "comment",
+    "question_tag",
+    "user_account",
+    "user_stats",
+    "user_vote_status",
+}
+
+
+class ExplainingCursor:
+    """Wraps a cursor and records the plan of every statement it executes"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, query, params=None):
+        # prepared statements are explained through their query text
+        self.cursor.execute("EXPLAIN (FORMAT JSON) " + str(query), params)
+        plan = self.cursor.fetchone()["QUERY PLAN"]
+        self.plans.append(plan if isinstance(plan, list) else json.loads(plan))
+        self.cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def get_sequential_scans(plan):
+    scans = set()
+    if plan.get("Node Type") == "Seq Scan" and plan["Relation Name"] in LARGE_TABLES:
+        scans.add(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scans |= get_sequential_scans(child)
+    return scans
+
+
+def seed(cursor, questions):
+    users, tags = max(questions // 10, 10), max(questions // 100, 10)
+    params = {"questions": questions, "users": users, "tags": tags}
+    cursor.execute(
+        """
+        SELECT coalesce((SELECT max(id) FROM question), 0) + 1 AS question_base,
+               coalesce((SELECT max(id) FROM answer), 0) + 1 AS answer_base,
+               coalesce((SELECT max(id) FROM tag), 0) + 1 AS tag_base"""
+    )
+    params.update(cursor.fetchone())
+    cursor.execute(
+        """
+        INSERT INTO user_account (id, user_name, email_address, registration_date, password, reputation)
+        SELECT 'seed-' || n, 'seed_user_' || n, 'seed' || n || '@example.com',
+               now() - n * interval '1 minute', 'seed-password-' || n, n %% 100
+        FROM generate_series(1, %(users)s) AS n;
+
+        INSERT INTO question (id, submission_time, view_number, vote_number, user_id, title, message, image)
+        SELECT %(question_base)s + n, now() - n * interval '1 second', n %% 1000, n %% 50,
+               'seed-' || (n %% %(users)s + 1),
+               'Seeded question ' || n || ' about ' || (ARRAY['python', 'sql', 'css', 'flask'])[n %% 4 + 1],
+               'Seeded message ' || n || ' with some words to search for', NULL
+        FROM generate_series(0, %(questions)s - 1) AS n;
+
+        INSERT INTO answer (id, submission_time, vote_number, accepted_status, question_id, user_id, message, image)
+        SELECT %(answer_base)s + n, now() - n * interval '1 second', n %% 20, n %% 7 = 0,
+               %(question_base)s + n / 2, 'seed-' || (n %% %(users)s + 1),
+               'Seeded answer ' || n || ' mentioning python', NULL
+        FROM generate_series(0, 2 * %(questions)s - 1) AS n;
+
+        INSERT INTO comment (question_id, answer_id, user_id, message, submission_time, edited_count)
+        SELECT CASE WHEN n %% 2 = 0 THEN %(question_base)s + n / 2 END,
+               CASE WHEN n %% 2 = 1 THEN %(answer_base)s + n END,
+               'seed-' || (n %% %(users)s + 1), 'Seeded comment ' || n, now() - n * interval '1 second', NULL
+        FROM generate_series(0, 2 * %(questions)s - 1) AS n;
+
+        INSERT INTO tag (id, name)
+        SELECT %(tag_base)s + n, 'seed_tag_' || n
+        FROM generate_series(0, %(tags)s - 1) AS n;
+
+        INSERT INTO question_tag (question_id, tag_id)
+        SELECT %(question_base)s + n, %(tag_base)s + n %% %(tags)s
+        FROM generate_series(0, %(questions)s - 1) AS n;
+
+        INSERT INTO user_vote_status (id, question_id)
+        SELECT 'seed-' || (n %% %(users)s + 1), (%(question_base)s + n)::text
+        FROM generate_series(0, %(questions)s - 1) AS n;
+
+        ANALYZE""",
+        params,
+    )
+    return params
+
+
+def get_hot_queries(seeded):
+    question_id = seeded["question_base"] + seeded["questions"] // 2
+    question_ids = list(range(question_id, question_id + 20))
+    user_id, email = "seed-1", "seed1@example.com"
+    limit = 21
+    return [
+        (
+            "get_all_questions",
+            data_manager.get_all_questions,
+            ("submission_time", "DESC", limit),
+        ),
+        (
+            "get_all_questions by title",
+            data_manager.get_all_questions,
+            ("title", "ASC", limit),
+        ),
+        (
+            "get_all_questions by views",
+            data_manager.get_all_questions,
+            ("view_number", "DESC", limit),
+        ),
+        (
+            "get_all_questions by votes",
+            data_manager.get_all_questions,
+            ("vote_number", "DESC", limit),
+        ),
+        (
+            "get_questions_view_data",
+            data_manager.get_questions_view_data,
+            (question_ids,),
+        ),
+        (
+            "get_question_thread",
+            data_manager.get_question_thread,
+            (question_id, user_id),
+        ),
+        (
+            "get_questions_by_tag",
+            data_manager.get_questions_by_tag,
+            ("seed_tag_1", limit),
+        ),
+        # a selective phrase, the seeded texts share most of their words
+        ("search_questions", data_manager.search_questions, (str(question_id), limit)),
+        (
+            "get_answer_snippets",
+            data_manager.get_answer_snippets,
+            (question_ids, "python"),
+        ),
+        (
+            "get_users_table",
+            data_manager.get_users_table,
+            ("registration_date", "ASC", limit),
+        ),
+        ("get_user", data_manager.get_user, (user_id,)),
+        ("get_user_by_email", data_manager.get_user_by_email, (email,)),
+        ("get_user_questions", data_manager.get_user_questions, (user_id,)),
+        ("get_user_answers", data_manager.get_user_answers, (user_id,)),
+        ("get_user_comments", data_manager.get_user_comments, (user_id,)),
+        ("vote_question", data_manager.vote_question, (question_id, "seed-2", 1, 5)),
+        (
+            "vote_answer",
+            data_manager.vote_answer,
+            (seeded["answer_base"], "seed-2", 1, 10),
+        ),
+    ]
+
+
+def check_query_plans(questions=100000):
+    """Returns {query name: tables read with a sequential scan} for every hot query"""
+    pool = database_common.get_pool()
+    connection = pool.getconn()
+    try:
+        connection.autocommit = False
+        with connection.cursor(cursor_factory=database_common.Cursor) as cursor:
+            seeded = seed(cursor, questions)
+            results = {}
+            for name, function, args in get_hot_queries(seeded):
+                explaining_cursor = ExplainingCursor(cursor)
+                # run the undecorated function so it uses the seeded transaction
+                inspect.unwrap(function)(explaining_cursor, *args)
+                scans = set()
+                for plan in explaining_cursor.plans:
+                    scans |= get_sequential_scans(plan[0]["Plan"])
+                results[name] = sorted(scans)
+        return results
+    finally:
+        connection.rollback()
+        pool.putconn(connection)
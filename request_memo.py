@@ -0,0 +1,76 @@
+# Memoizes the data_manager reads that opted in (connection_handler(memo=True)) while handling one Flask request.
+# An identical read (same function, same arguments) runs once per request, later calls get a copy of its result.
+# Results are copied in and out, so only small lookups that a request repeats opt in, never the large lists.
+# Any write made by the request empties the memo, so a read after a write always sees the new rows.
+# The memo lives in flask.g and is dropped at request teardown, with a debug log of the calls it collapsed.
+import collections
+import copy
+import logging
+
+import flask
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMemo:
+    def __init__(self):
+        self.results = {}
+        # call key: number of times it was answered from the memo
+        self.collapsed = collections.Counter()
+
+    def call(self, name, function, args, kwargs):
+        try:
+            key = (name, _freeze(args), _freeze(kwargs))
+            hash(key)
+        except TypeError:
+            return function(*args, **kwargs)
+        if key in self.results:
+            self.collapsed[key] += 1
+            # callers are free to modify what they get, the memoized result must stay intact
+            return copy.deepcopy(self.results[key])
+        result = function(*args, **kwargs)
+        self.results[key] = copy.deepcopy(result)
+        return result
+
+    def clear(self):
+        self.results.clear()
+
+    def report(self):
+        """Returns the collapsed calls as (description, number of calls saved) pairs, most saved first"""
+        return [(_describe(key), count) for key, count in self.collapsed.most_common()]
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _describe(key):
+    name, args, kwargs = key
+    arguments = [repr(arg) for arg in args]
+    arguments += [f"{keyword}={value!r}" for keyword, value in kwargs]
+    return f"{name}({', '.join(arguments)})"
+
+
+def get_memo():
+    """Returns the memo of the current request, None outside of a request"""
+    if not flask.has_request_context():
+        return None
+    if "memo" not in flask.g:
+        flask.g.memo = RequestMemo()
+    return flask.g.memo
+
+
+def teardown():
+    memo = flask.g.pop("memo", None)
+    if memo is not None and memo.collapsed and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "%s %s: %s duplicate data_manager call(s) collapsed: %s",
+            flask.request.method,
+            flask.request.path,
+            sum(memo.collapsed.values()),
+            ", ".join(f"{call} x{count}" for call, count in memo.report()),
+        )
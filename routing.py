@@ -0,0 +1,41 @@
+# Decides whether a data_manager read may be served by the read replica (PSQL_REPLICA_HOST).
+# Writes always go to the primary. After a write, the reads of the same request, and those of the same
+# session for READ_YOUR_WRITES_WINDOW seconds, go to the primary too, so users see their own changes
+# even while the replica lags behind.
+import contextlib
+import os
+import threading
+import time
+
+import flask
+
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("READ_YOUR_WRITES_WINDOW", 5))
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def primary():
+    """Sends every read made inside the block to the primary"""
+    depth = getattr(_local, "primary_depth", 0)
+    _local.primary_depth = depth + 1
+    try:
+        yield
+    finally:
+        _local.primary_depth = depth
+
+
+def may_use_replica():
+    if getattr(_local, "primary_depth", 0):
+        return False
+    if not flask.has_request_context():
+        return True
+    if flask.g.get("wrote"):
+        return False
+    return flask.session.get("primary_until", 0) <= time.time()
+
+
+def record_write():
+    if flask.has_request_context():
+        flask.g.wrote = True
+        flask.session["primary_until"] = time.time() + READ_YOUR_WRITES_WINDOW
@@ -0,0 +1,17 @@
+-- Full text search over question titles, question messages and answer messages.
+-- The search vectors are generated columns, so PostgreSQL keeps them up to date on every write
+-- (generated columns need PostgreSQL 12 or newer).
+
+ALTER TABLE question
+    ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(message, '')), 'B')
+    ) STORED;
+
+ALTER TABLE answer
+    ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(message, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_question_search_vector ON question USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS ix_answer_search_vector ON answer USING GIN (search_vector);
@@ -0,0 +1,15 @@
+-- One vote per user and question/answer, enforced by unique indexes so concurrent
+-- double clicks cannot count twice. Duplicates recorded before the indexes existed are dropped first.
+
+DELETE FROM user_vote_status AS duplicate
+USING user_vote_status AS original
+WHERE duplicate.ctid > original.ctid
+AND duplicate.id = original.id
+AND duplicate.question_id IS NOT DISTINCT FROM original.question_id
+AND duplicate.answer_id IS NOT DISTINCT FROM original.answer_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_user_vote_status_question
+    ON user_vote_status (id, question_id) WHERE question_id IS NOT NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_user_vote_status_answer
+    ON user_vote_status (id, answer_id) WHERE answer_id IS NOT NULL;
@@ -0,0 +1,64 @@
+-- Denormalized answer count and solved flag on question, kept in sync by triggers on answer.
+-- rebuild_question_counters() recomputes them from scratch and returns the number of repaired questions.
+
+ALTER TABLE question
+    ADD COLUMN IF NOT EXISTS answer_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS is_solved boolean NOT NULL DEFAULT FALSE;
+
+CREATE OR REPLACE FUNCTION rebuild_question_counters() RETURNS integer AS $$
+    WITH repaired AS (
+        UPDATE question
+        SET answer_count = coalesce(stats.answer_count, 0),
+            is_solved = coalesce(stats.is_solved, FALSE)
+        FROM question AS target
+        LEFT JOIN (
+            SELECT question_id, count(*) AS answer_count, bool_or(coalesce(accepted_status, FALSE)) AS is_solved
+            FROM answer
+            GROUP BY question_id
+        ) AS stats ON stats.question_id = target.id
+        WHERE question.id = target.id
+        AND (question.answer_count, question.is_solved)
+            IS DISTINCT FROM (coalesce(stats.answer_count, 0), coalesce(stats.is_solved, FALSE))
+        RETURNING question.id
+    )
+    SELECT count(*)::integer FROM repaired;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION refresh_question_solved(target_question_id integer) RETURNS void AS $$
+    UPDATE question
+    SET is_solved = EXISTS (
+        SELECT 1 FROM answer WHERE answer.question_id = target_question_id AND answer.accepted_status
+    )
+    WHERE id = target_question_id;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION maintain_question_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE question
+        SET answer_count = answer_count + 1,
+            is_solved = is_solved OR coalesce(NEW.accepted_status, FALSE)
+        WHERE id = NEW.question_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE question SET answer_count = answer_count - 1 WHERE id = OLD.question_id;
+        IF OLD.accepted_status THEN
+            PERFORM refresh_question_solved(OLD.question_id);
+        END IF;
+    ELSIF NEW.question_id IS DISTINCT FROM OLD.question_id THEN
+        UPDATE question SET answer_count = answer_count - 1 WHERE id = OLD.question_id;
+        UPDATE question SET answer_count = answer_count + 1 WHERE id = NEW.question_id;
+        PERFORM refresh_question_solved(OLD.question_id);
+        PERFORM refresh_question_solved(NEW.question_id);
+    ELSIF NEW.accepted_status IS DISTINCT FROM OLD.accepted_status THEN
+        PERFORM refresh_question_solved(NEW.question_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS answer_question_counters ON answer;
+CREATE TRIGGER answer_question_counters
+    AFTER INSERT OR DELETE OR UPDATE OF question_id, accepted_status ON answer
+    FOR EACH ROW EXECUTE PROCEDURE maintain_question_counters();
+
+SELECT rebuild_question_counters();
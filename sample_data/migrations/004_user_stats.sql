@@ -0,0 +1,79 @@
+-- Per-user question/answer/comment counts, maintained by triggers so the user directory
+-- and profile pages no longer aggregate the whole post tables.
+-- rebuild_user_stats() recomputes them from scratch and returns the number of repaired users.
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id CHARACTER VARYING(255) PRIMARY KEY,
+    questions integer NOT NULL DEFAULT 0,
+    answers integer NOT NULL DEFAULT 0,
+    comments integer NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION rebuild_user_stats() RETURNS integer AS $$
+    WITH stats AS (
+        SELECT user_account.id AS user_id,
+               (SELECT count(*) FROM question WHERE question.user_id = user_account.id)::integer AS questions,
+               (SELECT count(*) FROM answer WHERE answer.user_id = user_account.id)::integer AS answers,
+               (SELECT count(*) FROM comment WHERE comment.user_id = user_account.id)::integer AS comments
+        FROM user_account
+    ),
+    repaired AS (
+        INSERT INTO user_stats (user_id, questions, answers, comments)
+        SELECT user_id, questions, answers, comments FROM stats
+        ON CONFLICT (user_id) DO UPDATE
+        SET questions = excluded.questions, answers = excluded.answers, comments = excluded.comments
+        WHERE (user_stats.questions, user_stats.answers, user_stats.comments)
+            IS DISTINCT FROM (excluded.questions, excluded.answers, excluded.comments)
+        RETURNING user_id
+    )
+    SELECT count(*)::integer FROM repaired;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION maintain_user_stats() RETURNS trigger AS $$
+DECLARE
+    counter text := TG_TABLE_NAME || 's';
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        EXECUTE format('UPDATE user_stats SET %I = %I - 1 WHERE user_id = $1', counter, counter)
+        USING OLD.user_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        EXECUTE format(
+            'INSERT INTO user_stats (user_id, %I) VALUES ($1, 1) '
+            'ON CONFLICT (user_id) DO UPDATE SET %I = user_stats.%I + 1',
+            counter, counter, counter
+        )
+        USING NEW.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION create_user_stats() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_stats (user_id) VALUES (NEW.id) ON CONFLICT (user_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS question_user_stats ON question;
+CREATE TRIGGER question_user_stats
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON question
+    FOR EACH ROW EXECUTE PROCEDURE maintain_user_stats();
+
+DROP TRIGGER IF EXISTS answer_user_stats ON answer;
+CREATE TRIGGER answer_user_stats
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON answer
+    FOR EACH ROW EXECUTE PROCEDURE maintain_user_stats();
+
+DROP TRIGGER IF EXISTS comment_user_stats ON comment;
+CREATE TRIGGER comment_user_stats
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON comment
+    FOR EACH ROW EXECUTE PROCEDURE maintain_user_stats();
+
+DROP TRIGGER IF EXISTS user_account_user_stats ON user_account;
+CREATE TRIGGER user_account_user_stats
+    AFTER INSERT ON user_account
+    FOR EACH ROW EXECUTE PROCEDURE create_user_stats();
+
+SELECT rebuild_user_stats();
@@ -0,0 +1,41 @@
+-- Secondary indexes for the columns the data_manager queries filter, join and sort on.
+-- user_account.email_address and user_account.user_name are already indexed by their UNIQUE constraints,
+-- user_vote_status by the unique indexes of 002 and question_tag.question_id by its primary key.
+
+CREATE INDEX IF NOT EXISTS ix_answer_question_id ON answer (question_id);
+CREATE INDEX IF NOT EXISTS ix_answer_user_id ON answer (user_id);
+CREATE INDEX IF NOT EXISTS ix_comment_question_id ON comment (question_id);
+CREATE INDEX IF NOT EXISTS ix_comment_answer_id ON comment (answer_id);
+CREATE INDEX IF NOT EXISTS ix_comment_user_id ON comment (user_id);
+CREATE INDEX IF NOT EXISTS ix_question_tag_tag_id ON question_tag (tag_id);
+CREATE INDEX IF NOT EXISTS ix_question_user_id ON question (user_id);
+
+-- keyset pagination of /list, the id tie-breaker is part of every index
+-- (message is not indexed: long messages exceed the btree entry size limit)
+CREATE INDEX IF NOT EXISTS ix_question_submission_time ON question (submission_time, id);
+CREATE INDEX IF NOT EXISTS ix_question_title ON question (title, id);
+CREATE INDEX IF NOT EXISTS ix_question_view_number ON question (view_number, id);
+CREATE INDEX IF NOT EXISTS ix_question_vote_number ON question (vote_number, id);
+
+-- keyset pagination of /users
+CREATE INDEX IF NOT EXISTS ix_user_account_registration_date ON user_account (registration_date, id);
+CREATE INDEX IF NOT EXISTS ix_user_account_reputation ON user_account (reputation, id);
+
+-- tag names become unique: questions tagged with a duplicate are moved to the oldest tag of that name
+INSERT INTO question_tag (question_id, tag_id)
+SELECT question_tag.question_id, kept.id
+FROM question_tag
+JOIN tag AS duplicate ON duplicate.id = question_tag.tag_id
+JOIN (SELECT name, min(id) AS id FROM tag GROUP BY name) AS kept ON kept.name = duplicate.name
+WHERE duplicate.id <> kept.id
+ON CONFLICT DO NOTHING;
+
+DELETE FROM question_tag
+USING tag AS duplicate, (SELECT name, min(id) AS id FROM tag GROUP BY name) AS kept
+WHERE question_tag.tag_id = duplicate.id AND kept.name = duplicate.name AND duplicate.id <> kept.id;
+
+DELETE FROM tag
+USING (SELECT name, min(id) AS id FROM tag GROUP BY name) AS kept
+WHERE kept.name = tag.name AND tag.id <> kept.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_tag_name ON tag (name);
@@ -1,11 +1,136 @@
-from flask import Flask, session, render_template, redirect, request, url_for
-
+from flask import Flask, session, render_template, redirect, request, url_for, abort
+from flask import Response, g, stream_with_context
+import click
+import hmac
+import time
+
+import benchmarks
+import cache
 import data_manager
+import database_common
+import export
+import importer
+import metrics
+import migrations
+import passwords
+import profiler
+import query_plans
+import request_memo
 import utils
+import view_counter
 import os
 
 app = Flask(__name__)
-app.secret_key = os.urandom(16)
+# every worker must sign the session cookies with the same key, a random key only suits the dev server
+app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(16)
+
+
+@app.errorhandler(passwords.PasswordQueueFull)
+def password_queue_full(error):
+    return (
+        "Too many sign-ins at the moment, please try again in a few seconds.",
+        503,
+        {"Retry-After": "2"},
+    )
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.request_started()
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.request_finished(
+        route,
+        request.method,
+        response.status_code,
+        time.perf_counter() - g.request_started,
+    )
+    return response
+
+
+def collect_pool_and_cache_metrics():
+    samples = []
+    for role in database_common.get_roles():
+        pool = database_common.pool_status(role)
+        if pool is None:
+            continue
+        samples += [
+            (
+                "askmate_db_pool_connections",
+                {"pool": role, "state": "in_use"},
+                pool["in_use"],
+                metrics.LIVE,
+            ),
+            (
+                "askmate_db_pool_connections",
+                {"pool": role, "state": "idle"},
+                pool["idle"],
+                metrics.LIVE,
+            ),
+            (
+                "askmate_db_pool_max_connections",
+                {"pool": role},
+                pool["max_size"],
+                metrics.LIVE,
+            ),
+            ("askmate_db_pool_waits_total", {"pool": role}, pool["waits"], metrics.SUM),
+            (
+                "askmate_db_pool_timeouts_total",
+                {"pool": role},
+                pool["timeouts"],
+                metrics.SUM,
+            ),
+        ]
+    cache_status = cache.status()
+    if "hits" in cache_status:
+        # a shared cache reports the same totals to every worker
+        merge = metrics.MAX if cache_status["backend"] == "shared" else metrics.SUM
+        samples += [
+            (
+                "askmate_cache_requests_total",
+                {"result": "hit"},
+                cache_status["hits"],
+                merge,
+            ),
+            (
+                "askmate_cache_requests_total",
+                {"result": "miss"},
+                cache_status["misses"],
+                merge,
+            ),
+            ("askmate_cache_evictions_total", {}, cache_status["evictions"], merge),
+        ]
+    return samples
+
+
+metrics.register_collector(collect_pool_and_cache_metrics)
+
+
+@app.route("/metrics")
+def metrics_page():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.after_request
+def report_query_profile(response):
+    return profiler.report(response)
+
+
+@app.context_processor
+def inject_query_profile():
+    return {
+        "query_profile": profiler.get_profile() if profiler.PROFILER_TOOLBAR else None,
+        "query_repeat_threshold": profiler.QUERY_REPEAT_THRESHOLD,
+    }
+
+
+@app.teardown_request
+def drop_request_memo(exception):
+    request_memo.teardown()
 
 
 @app.route("/style-mode")
@@ -24,35 +149,60 @@ def style_mode():
     return background_color, font_color
 
 
+def get_page_links(previous_cursor, next_cursor, **page_args):
+    return (
+        url_for(request.endpoint, before=previous_cursor, **page_args)
+        if previous_cursor
+        else None,
+        url_for(request.endpoint, after=next_cursor, **page_args)
+        if next_cursor
+        else None,
+    )
+
+
 @app.route("/")
 @app.route("/list")
 def index():
-    all_questions = utils.update_to_pretty_time(
-        utils.get_formatted_dicts(data_manager.get_all_questions())
-    )
     background_color, font_color = style_mode()
-
-    if request.args:
-        all_questions = utils.get_formatted_dicts(
-            data_manager.get_all_questions(
-                request.args["order_by"], request.args["order_direction"]
-            )
+    order_by = request.args.get("order_by", "submission_time")
+    order_direction = request.args.get("order_direction", "DESC")
+    list_page = "list" in request.base_url
+    limit = utils.get_page_limit(request.args) if list_page else utils.HOME_PAGE_SIZE
+    after = utils.decode_cursor(request.args.get("after"))
+    before = utils.decode_cursor(request.args.get("before"))
+    all_questions = data_manager.get_all_questions(
+        order_by, order_direction, limit + 1, after, before
+    )
+    if all_questions is None:
+        abort(400)
+    all_questions, previous_cursor, next_cursor = utils.paginate(
+        all_questions, limit, after, before
+    )
+    all_questions = utils.add_questions_view_data(
+        utils.update_to_pretty_time(utils.get_formatted_dicts(all_questions))
+    )
+    previous_page, next_page = (
+        get_page_links(
+            previous_cursor,
+            next_cursor,
+            order_by=order_by,
+            order_direction=order_direction,
+            limit=limit,
         )
+        if list_page
+        else (None, None)
+    )
 
     return render_template(
         "index.html",
-        all_questions=all_questions
-        if "list" in request.base_url
-        else all_questions[:5],
+        all_questions=all_questions,
+        previous_page=previous_page,
+        next_page=next_page,
         background_color=background_color,
         font_color=font_color,
-        count_question_answers=data_manager.count_question_answers,
         session=session,
-        has_question_privilege=utils.has_question_privilege,
-        question_tags=data_manager.get_question_tags,
         username=utils.get_username(session),
         current_user_id=utils.get_current_user_id(session),
-        owner_user_name=data_manager.get_user_name_by_user_id,
     )
 
 
@@ -60,11 +210,35 @@ def index():
 def users_page():
     background_color, font_color = style_mode()
     day, night = utils.get_table_page_style(session.get("style_mode"))
-    users_table = data_manager.get_users_table()
+    order_by = request.args.get("order_by", "registration_date")
+    order_direction = request.args.get("order_direction", "ASC")
+    limit = utils.get_page_limit(request.args)
+    # user ids are varchar, their cursors are kept as strings
+    after = utils.decode_cursor(request.args.get("after"), str)
+    before = utils.decode_cursor(request.args.get("before"), str)
+    users_table = data_manager.get_users_table(
+        order_by, order_direction, limit + 1, after, before
+    )
+    if users_table is None:
+        abort(400)
+    users_table, previous_cursor, next_cursor = utils.paginate(
+        users_table, limit, after, before
+    )
+    previous_page, next_page = get_page_links(
+        previous_cursor,
+        next_cursor,
+        order_by=order_by,
+        order_direction=order_direction,
+        limit=limit,
+    )
 
     return render_template(
         "users.html",
         users_table=users_table,
+        order_by=order_by,
+        order_direction=order_direction.upper(),
+        previous_page=previous_page,
+        next_page=next_page,
         background_color=background_color,
         page_title="Users page",
         username=utils.get_username(session),
@@ -78,15 +252,16 @@ def users_page():
 def user_page(user_id):
     background_color, font_color = style_mode()
     day, night = utils.get_table_page_style(session.get("style_mode"))
-    users_table = data_manager.get_users_table()
-    user_details = [user for user in users_table if user["id"] == user_id][0]
+    user_details = data_manager.get_user(user_id)
+    if user_details is None:
+        abort(404)
     user_questions = data_manager.get_user_questions(user_id)
     user_answers = data_manager.get_user_answers(user_id)
     user_comments = data_manager.get_user_comments(user_id)
 
     return render_template(
         "users.html",
-        users_table=users_table,
+        users_table=[user_details],
         background_color=background_color,
         day=day,
         night=night,
@@ -98,9 +273,6 @@ def user_page(user_id):
         user_questions=user_questions,
         user_answers=user_answers,
         user_comments=user_comments,
-        question_accepted_answers=data_manager.get_accepted_status_by_question_id,
-        is_question_solved=utils.get_keys,
-        question_id=data_manager.get_question_id_by_answer_id,
     )
 
 
@@ -109,21 +281,35 @@ def user_page(user_id):
 def tag_list(selected_tag=None):
     background_color, font_color = style_mode()
     day, night = utils.get_table_page_style(session.get("style_mode"))
-    tags = data_manager.get_all_tags()
-    get_questions_by_tag = data_manager.get_questions_by_tag
+    tags = data_manager.get_tag_index()
+    tag_questions, previous_page, next_page = [], None, None
+
+    if selected_tag:
+        limit = utils.get_page_limit(request.args)
+        after = utils.decode_cursor(request.args.get("after"))
+        before = utils.decode_cursor(request.args.get("before"))
+        tag_questions, previous_cursor, next_cursor = utils.paginate(
+            data_manager.get_questions_by_tag(selected_tag, limit + 1, after, before),
+            limit,
+            after,
+            before,
+        )
+        previous_page, next_page = get_page_links(
+            previous_cursor, next_cursor, selected_tag=selected_tag, limit=limit
+        )
 
     return render_template(
         "tag_list.html",
         tags=tags,
-        get_questions_by_tag=get_questions_by_tag,
+        tag_questions=tag_questions,
         selected_tag=selected_tag,
+        previous_page=previous_page,
+        next_page=next_page,
         background_color=background_color,
         day=day,
         night=night,
         username=utils.get_username(session),
         current_user_id=utils.get_current_user_id(session),
-        question_accepted_answers=data_manager.get_accepted_status_by_question_id,
-        is_question_solved=utils.get_keys,
     )
 
 
@@ -138,8 +324,11 @@ def sign_up():
         elif utils.is_username_taken(request):
             user_name_taken = True
         else:
-            utils.add_user(request)
-            return redirect("/")
+            taken = utils.add_user(request)
+            if taken is None:
+                return redirect("/")
+            already_register_email = taken == "email"
+            user_name_taken = taken == "username"
 
     return render_template(
         "form.html",
@@ -158,8 +347,9 @@ def sign_in():
     invalid_credentials = False
 
     if request.form:
-        if utils.are_valid_credentials(request):
-            session.update({"email": request.form["email"]})
+        user = utils.are_valid_credentials(request)
+        if user:
+            utils.sign_in(session, user)
             return redirect("/")
         else:
             invalid_credentials = True
@@ -176,22 +366,23 @@ def sign_in():
 
 @app.route("/sign-out")
 def sign_out():
-    session.pop("email", None)
+    utils.sign_out(session)
     return redirect("/")
 
 
 @app.route("/search")
 def search():
     background_color, font_color = style_mode()
-    questions = utils.update_to_pretty_time(
-        data_manager.get_questions_with_phrase(request.values.get("q"))
+    phrase = request.values.get("q")
+    page = max(request.args.get("page", 1, type=int), 1)
+    questions = data_manager.search_questions(
+        phrase, utils.SEARCH_PAGE_SIZE + 1, (page - 1) * utils.SEARCH_PAGE_SIZE
     )
-    question_ids = tuple([q["id"] for q in questions])
-    answers = utils.update_to_pretty_time(
-        data_manager.get_answers_with_message_by_question_ids(
-            question_ids, request.values.get("q")
-        )
+    has_next_page = len(questions) > utils.SEARCH_PAGE_SIZE
+    questions = utils.add_questions_view_data(
+        utils.update_to_pretty_time(questions[: utils.SEARCH_PAGE_SIZE])
     )
+    answers = data_manager.get_answer_snippets([q["id"] for q in questions], phrase)
     if request.args:
         session.update({"q": request.args["q"]})
 
@@ -201,49 +392,39 @@ def search():
         all_questions=questions,
         background_color=background_color,
         font_color=font_color,
-        phrase=request.values.get("q"),
-        count_question_answers=data_manager.count_question_answers,
+        phrase=phrase,
+        previous_page=url_for("search", q=phrase, page=page - 1) if page > 1 else None,
+        next_page=url_for("search", q=phrase, page=page + 1) if has_next_page else None,
         session=session,
-        has_question_privilege=utils.has_question_privilege,
-        question_tags=data_manager.get_question_tags,
         username=utils.get_username(session),
         current_user_id=utils.get_current_user_id(session),
-        owner_user_name=data_manager.get_user_name_by_user_id,
     )
 
 
 @app.route("/question/<question_id>")
 def question_page(question_id):
     background_color, font_color = style_mode()
-    data_manager.update_views(question_id) if request.method == "GET" else None
-    question = utils.get_formatted_dict(data_manager.get_question(question_id))
-    question.update(
-        {"submission_time": utils.get_pretty_time(question["submission_time"])}
-    )
-    question_comments = utils.update_to_pretty_time(
-        utils.get_formatted_dicts(data_manager.get_question_comments(question_id))
-    )
-    answers = utils.update_to_pretty_time(
-        utils.get_formatted_dicts(data_manager.get_answers_by_question_id(question_id))
-    )
+    current_user_id = utils.get_current_user_id(session)
+    question = data_manager.get_question_thread(question_id, current_user_id)
+    if question is None:
+        abort(404)
+    view_counter.record_view(question["id"])
+    # views still waiting in the buffer are shown right away
+    question["view_number"] += view_counter.pending_views(question["id"])
+    utils.format_question_thread(question)
 
     return render_template(
         "question_display.html",
         question=question,
-        answers=answers,
-        question_comments=question_comments,
-        answer_comments=data_manager.get_answer_comments,
-        question_tags=data_manager.get_question_tags(question_id),
+        answers=question["answers"],
+        question_comments=question["comments"],
+        question_tags=question["tags"],
         background_color=background_color,
         font_color=font_color,
         session=session,
-        has_question_privilege=utils.has_question_privilege(session, question_id),
-        has_answer_privilege=utils.has_answer_privilege,
-        has_comment_privilege=utils.has_comment_privilege,
+        has_question_privilege=question["is_owner"],
         username=utils.get_username(session),
-        current_user_id=utils.get_current_user_id(session),
-        update_answers_comments=utils.update_to_pretty_time,
-        owner_user_name=data_manager.get_user_name_by_user_id,
+        current_user_id=current_user_id,
     )
 
 
@@ -266,7 +447,9 @@ def add_form(page):
         all_tags, question_tags, question_tags_string = utils.get_tags(page_id)
 
     if request.form:
-        redirect_page = utils.add_and_redirect(page, request, session.get("email"))
+        redirect_page = utils.add_and_redirect(
+            page, request, utils.get_current_user_id(session)
+        )
         return redirect(redirect_page)
 
     return render_template(
@@ -331,14 +514,157 @@ def accepted_status():
         bool(int(request.values.get("status"))),
         request.values.get("question_id"),
     )
-    answer_owner_id = data_manager.get_user_id_by_answer_id(idx).get("user_id")
-
-    data_manager.update_accepted_status(idx, status)
-    data_manager.update_reputation(answer_owner_id, 15 if status else -15)
+    with database_common.unit_of_work():
+        answer_owner_id = data_manager.update_accepted_status(idx, status)
+        if answer_owner_id is not None:
+            data_manager.update_reputation(answer_owner_id, 15 if status else -15)
 
     return redirect(f"/question/{question_id}#{idx}")
 
 
+@app.route("/export/<table>.<export_format>")
+def export_table(table, export_format):
+    # disabled unless EXPORT_TOKEN is set, clients send it as a bearer token
+    token = os.environ.get("EXPORT_TOKEN")
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        abort(401)
+    if table not in export.TABLES or export_format not in export.FORMATS:
+        abort(404)
+    try:
+        after = (
+            export.parse_key(table, request.args["after"])
+            if "after" in request.args
+            else None
+        )
+    except ValueError:
+        abort(400)
+    compress = request.args.get("gzip") == "1"
+    filename = f"{table}.{export_format}" + (".gz" if compress else "")
+    return Response(
+        stream_with_context(export.stream(table, export_format, after, compress)),
+        mimetype="application/gzip"
+        if compress
+        else ("application/x-ndjson" if export_format == "ndjson" else "text/csv"),
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+@app.cli.command("rebuild-counters")
+def rebuild_counters():
+    """Recomputes the denormalized question counters and user statistics."""
+    print(f"{data_manager.rebuild_question_counters()} question(s) repaired")
+    print(f"{data_manager.rebuild_user_stats()} user(s) repaired")
+
+
+def warmup():
+    """Prepares a freshly started worker before it accepts requests."""
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
+    database_common.get_pool()
+    database_common.prepare_statements()
+    data_manager.get_tag_index()
+    passwords.get_executor()
+    utils.start_user_filters()
+
+
+def shutdown():
+    """Releases the resources of a worker once its last request is served."""
+    view_counter.flush()
+    if metrics.METRICS_DIR:
+        metrics.save()
+    passwords.shutdown()
+    database_common.close_pool()
+
+
+@app.cli.command("migrate")
+def migrate():
+    """Applies the pending schema migrations."""
+    for version, name in migrations.migrate():
+        print(f"applied {version:03d}_{name}")
+
+
+@app.cli.command("check-query-plans")
+@click.option("--questions", default=100000, help="Number of questions to seed.")
+def check_query_plans(questions):
+    """Fails if a hot query reads a large table with a sequential scan."""
+    failed = False
+    for name, tables in query_plans.check_query_plans(questions).items():
+        print(
+            f"{name}: {'sequential scan on ' + ', '.join(tables) if tables else 'ok'}"
+        )
+        failed = failed or bool(tables)
+    if failed:
+        raise SystemExit(1)
+
+
+@app.cli.command("export")
+@click.argument("tables", nargs=-1)
+@click.option(
+    "--format", "export_format", type=click.Choice(export.FORMATS), default="ndjson"
+)
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the exported files.")
+@click.option(
+    "--output-dir", default="exports", help="Directory of the exported files."
+)
+@click.option(
+    "--resume", is_flag=True, help="Continue after the last checkpointed row."
+)
+def export_tables(tables, export_format, compress, output_dir, resume):
+    """Exports the given tables (all of them by default), one file per table."""
+    os.makedirs(output_dir, exist_ok=True)
+    for table in tables or export.TABLES:
+        if table not in export.TABLES:
+            raise click.BadParameter(f"unknown table {table}")
+        exported = export.export_table(
+            output_dir, table, export_format, compress, resume
+        )
+        print(
+            f"{table}: {exported} row(s) written to "
+            + export.get_path(output_dir, table, export_format, compress)
+        )
+
+
+@app.cli.command("import-dumps")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def import_dumps(directory):
+    """Imports the NDJSON or CSV dumps of DIRECTORY in one transaction."""
+    started = time.perf_counter()
+    results = importer.import_dumps(directory)
+    seconds = time.perf_counter() - started
+    for table, (staged, imported) in results.items():
+        print(f"{table}: {imported} of {staged} row(s) imported")
+    staged = sum(staged for staged, _ in results.values())
+    print(f"{staged} row(s) in {seconds:.1f}s ({staged / seconds:.0f} rows/s)")
+
+
+@app.cli.command("benchmark-prepared-statements")
+@click.option("--iterations", default=200, help="Executions of every statement.")
+def benchmark_prepared_statements(iterations):
+    """Compares the planning and execution time of the prepared statements with plain queries."""
+    print(f"{'statement':<28} {'planning ms':>20} {'ms per call':>20}")
+    print(f"{'':<28} {'plain':>10}{'prepared':>10} {'plain':>10}{'prepared':>10}")
+    for name, *timings in benchmarks.benchmark_prepared_statements(iterations):
+        print(f"{name:<28} " + "{:>10.3f}{:>10.3f} {:>10.3f}{:>10.3f}".format(*timings))
+
+
+@app.cli.command("benchmark-row-memory")
+@click.option("--rows", default=100000, help="Rows fetched with each cursor.")
+def benchmark_row_memory(rows):
+    """Compares the memory held by RealDictCursor rows and compact rows."""
+    print(
+        f"{'cursor':<14} {'retained MB':>12} {'peak MB':>10} {'bytes/row':>10} {'fetch s':>8}"
+    )
+    for name, retained, peak, seconds in benchmarks.benchmark_row_memory(rows):
+        print(
+            f"{name:<14} {retained / 2**20:>12.1f} {peak / 2**20:>10.1f} "
+            f"{retained / rows:>10.0f} {seconds:>8.2f}"
+        )
+
+
 if __name__ == "__main__":
     app.config["UPLOAD_FOLDER"] = "/static/images"
     app.run(debug=True)
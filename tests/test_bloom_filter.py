@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import data_manager
+import utils
+from bloom_filter import BloomFilter
+
+
+def test_added_values_are_always_found():
+    bloom = BloomFilter(1000)
+    emails = [f"user_{index}@example.com" for index in range(1000)]
+    for email in emails:
+        bloom.add(email)
+    assert all(email in bloom for email in emails)
+    false_positives = sum(
+        f"other_{index}@example.com" in bloom for index in range(10000)
+    )
+    assert false_positives < 300
+
+
+class Stop(Exception):
+    pass
+
+
+@pytest.fixture
+def filters(monkeypatch):
+    monkeypatch.setattr(utils, "USE_USER_BLOOM_FILTER", True)
+    # the filters are built by the test, not by a background thread
+    monkeypatch.setattr(utils, "_user_filters_pid", os.getpid())
+    monkeypatch.setattr(utils, "_user_filters", None)
+    monkeypatch.setattr(utils, "_user_filters_signed_up", [])
+
+    def sleep(seconds):
+        raise Stop
+
+    monkeypatch.setattr(utils.time, "sleep", sleep)
+
+
+def test_sign_ups_during_a_refresh_are_kept(filters, monkeypatch):
+    def get_user_identities():
+        # a user signs up while the identities are loaded
+        utils.add_to_user_filters("new@example.com", "new")
+        return [{"email_address": "old@example.com", "user_name": "old"}]
+
+    monkeypatch.setattr(data_manager, "get_user_identities", get_user_identities)
+    with pytest.raises(Stop):
+        utils.refresh_user_filters()
+    emails, user_names = utils.get_user_filters()
+    assert "old@example.com" in emails and "new@example.com" in emails
+    assert "old" in user_names and "new" in user_names
+
+
+class Form:
+    def __init__(self, **form):
+        self.form = form
+
+
+def test_database_is_asked_only_about_possible_matches(filters, monkeypatch):
+    asked = []
+    monkeypatch.setattr(
+        data_manager, "is_email_registered", lambda email: asked.append(email) or True
+    )
+    # until the filters are built every check goes to the database
+    assert utils.is_email_already_register(Form(email="a@example.com"))
+    utils._user_filters = (BloomFilter(10), BloomFilter(10))
+    utils.add_to_user_filters("a@example.com", "a")
+    assert not utils.is_email_already_register(Form(email="b@example.com"))
+    assert utils.is_email_already_register(Form(email="a@example.com"))
+    assert asked == ["a@example.com", "a@example.com"]
@@ -0,0 +1,88 @@
+import pytest
+
+import cache
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = cache.LRUCache(max_entries=2)
+    monkeypatch.setattr(cache, "get_backend", lambda: backend)
+    return backend
+
+
+def test_lookup_returns_stored_values_until_they_expire():
+    lru = cache.LRUCache()
+    value, generation = lru.lookup("key")
+    assert value is None
+    assert lru.store("key", b"value", 60, generation)
+    assert lru.lookup("key")[0] == b"value"
+    lru.store("expired", b"value", 0, generation)
+    assert lru.lookup("expired")[0] is None
+    assert lru.status()["expirations"] == 1
+
+
+def test_load_overlapping_an_invalidation_is_not_stored():
+    lru = cache.LRUCache()
+    _, generation = lru.lookup("key")
+    lru.delete(["other"])
+    assert not lru.store("key", b"stale", 60, generation)
+    assert lru.lookup("key")[0] is None
+    _, generation = lru.lookup("key")
+    lru.clear()
+    assert not lru.store("key", b"stale", 60, generation)
+
+
+def test_delete_drops_only_the_given_keys():
+    lru = cache.LRUCache()
+    generation = lru.lookup("a")[1]
+    lru.store("a", b"a", 60, generation)
+    lru.store("b", b"b", 60, generation)
+    lru.delete(["a"])
+    assert lru.lookup("a")[0] is None
+    assert lru.lookup("b")[0] == b"b"
+    assert lru.status()["invalidations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    lru = cache.LRUCache(max_entries=2)
+    generation = lru.lookup("a")[1]
+    for key in ("a", "b"):
+        lru.store(key, key.encode(), 60, generation)
+    lru.lookup("a")
+    lru.store("c", b"c", 60, generation)
+    assert lru.lookup("b")[0] is None
+    assert lru.lookup("a")[0] == b"a"
+    assert lru.status()["evictions"] == 1
+
+
+def test_keys_match_ids_given_as_strings_or_integers():
+    assert cache.make_key("f", ("12",), {}) == cache.make_key("f", (12,), {})
+    assert cache.make_key("f", (), {"id": "12"}) == cache.make_key("f", (), {"id": 12})
+    # user ids and padded values keep their text
+    assert cache.make_key("f", ("0123",), {}) == ("f", "0123")
+    assert cache.make_key("f", ("031f03690527",), {}) == ("f", "031f03690527")
+
+
+def test_local_entries_are_kept_for_a_short_ttl(monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_BACKEND_ADDRESS", None)
+    assert cache.get_ttl(300) == cache.CACHE_LOCAL_TTL
+    monkeypatch.setattr(cache, "CACHE_BACKEND_ADDRESS", "127.0.0.1:11311")
+    assert cache.get_ttl(300) == 300
+
+
+def test_cached_function_is_read_once_until_invalidated(backend):
+    calls = []
+
+    @cache.cached()
+    def get_row(row_id):
+        calls.append(row_id)
+        return {"id": row_id}
+
+    assert get_row(1) == get_row("1") == {"id": 1}
+    assert calls == [1]
+    # every caller gets its own copy
+    get_row(1)["id"] = 2
+    assert get_row(1) == {"id": 1}
+    cache.invalidate(get_row.cache_key(1))
+    get_row(1)
+    assert calls == [1, 1]
@@ -0,0 +1,106 @@
+import copy
+import pickle
+
+import pytest
+
+import database_common
+
+
+def test_placeholders_are_numbered_in_order_of_first_appearance():
+    statement = database_common.PreparedStatement(
+        "find",
+        "SELECT * FROM question WHERE user_id = %(user_id)s AND title LIKE '%%' || %(phrase)s"
+        " OR user_id = %(user_id)s",
+    )
+    assert statement.params == ["user_id", "phrase"]
+    assert statement.statement == (
+        "SELECT * FROM question WHERE user_id = $1 AND title LIKE '%' || $2 OR user_id = $1"
+    )
+    assert statement.execute_query == "EXECUTE find (%s, %s)"
+    assert str(statement).endswith("OR user_id = %(user_id)s")
+
+
+def test_statement_without_parameters_is_executed_by_name():
+    statement = database_common.PreparedStatement("count", "SELECT count(*) FROM tag")
+    assert statement.params == []
+    assert statement.execute_query == "EXECUTE count"
+
+
+class RecordingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+
+class FakePreparingCursor(database_common.PreparingCursor, RecordingCursor):
+    pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.prepared = set()
+
+
+def test_statements_are_prepared_once_per_connection(monkeypatch):
+    monkeypatch.setattr(database_common, "PREPARED_STATEMENTS_ENABLED", True)
+    statement = database_common.PreparedStatement(
+        "get_pair", "SELECT %(b)s, %(a)s, %(b)s"
+    )
+    cursor = FakePreparingCursor(FakeConnection())
+    cursor.execute(statement, {"a": 1, "b": 2})
+    cursor.execute(statement, {"a": 3, "b": 4})
+    assert cursor.executed == [
+        ("PREPARE get_pair AS SELECT $1, $2, $1", None),
+        ("EXECUTE get_pair (%s, %s)", [2, 1]),
+        ("EXECUTE get_pair (%s, %s)", [4, 3]),
+    ]
+
+
+def test_plain_query_is_run_when_prepared_statements_are_disabled(monkeypatch):
+    monkeypatch.setattr(database_common, "PREPARED_STATEMENTS_ENABLED", False)
+    statement = database_common.PreparedStatement("get_one", "SELECT %(a)s")
+    cursor = FakePreparingCursor(FakeConnection())
+    cursor.execute(statement, {"a": 1})
+    assert cursor.executed == [("SELECT %(a)s", {"a": 1})]
+
+
+def make_rows():
+    positions = {"id": 0, "title": 1}
+    return [
+        database_common.Row(positions, (1, "first")),
+        database_common.Row(positions, (2, "second")),
+    ]
+
+
+def test_row_reads_like_a_dictionary():
+    row = make_rows()[0]
+    assert row["title"] == row.title == "first"
+    assert row == {"id": 1, "title": "first"}
+    assert dict(row.items()) == {"id": 1, "title": "first"}
+    assert "id" in row and "message" not in row
+    assert row.get("message", "") == ""
+    with pytest.raises(KeyError):
+        row["message"]
+    with pytest.raises(AttributeError):
+        row.message
+
+
+def test_row_writes_do_not_leak_into_other_rows():
+    first, second = make_rows()
+    first["title"] = "changed"
+    first.update(snippet="<strong>x</strong>")
+    assert first == {"id": 1, "title": "changed", "snippet": "<strong>x</strong>"}
+    assert len(first) == 3
+    assert second == {"id": 2, "title": "second"}
+
+
+def test_row_survives_copy_and_pickle():
+    row = make_rows()[0]
+    row["extra"] = [1]
+    copied = copy.deepcopy(row)
+    copied["extra"].append(2)
+    assert row["extra"] == [1]
+    assert pickle.loads(pickle.dumps(row)) == row
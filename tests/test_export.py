@@ -0,0 +1,49 @@
+import datetime
+import gzip
+import json
+
+import pytest
+
+import export
+import importer
+
+
+def test_users_are_exported_before_the_tables_that_reference_them():
+    tables = list(export.TABLES)
+    assert tables.index("user_account") < tables.index("question")
+    assert list(importer.TABLES) == [
+        "user_account",
+        "tag",
+        "question",
+        "answer",
+        "comment",
+        "question_tag",
+    ]
+    assert importer.TABLES["user_account"] == export.TABLES["user_account"][0]
+
+
+def test_keys_round_trip_through_the_endpoint_format():
+    row = {"question_id": 3, "tag_id": 11}
+    key = export.get_key("question_tag", row)
+    assert export.parse_key("question_tag", ",".join(map(str, key))) == key
+    assert export.parse_key("question", "42") == [42]
+    # user ids are varchar and keep their leading zeros
+    assert export.parse_key("user_account", "031f03690527") == ["031f03690527"]
+    with pytest.raises(ValueError):
+        export.parse_key("question_tag", "3")
+    with pytest.raises(ValueError):
+        export.parse_key("question", "x")
+
+
+def test_batches_are_encoded_as_ndjson_or_csv():
+    rows = [{"id": 1, "name": "python"}, {"id": 2, "name": "sql, joins"}]
+    ndjson = export.encode_batch("tag", rows, "ndjson")
+    assert [json.loads(line) for line in ndjson.decode().splitlines()] == rows
+    csv = export.encode_batch("tag", rows, "csv", header=True)
+    assert csv.decode().splitlines() == ["id,name", "1,python", '2,"sql, joins"']
+    timestamp = [{"id": 1, "submission_time": datetime.datetime(2022, 1, 2, 3, 4)}]
+    assert json.loads(
+        gzip.decompress(
+            export.encode_batch("comment", timestamp, "ndjson", compress=True)
+        )
+    ) == {"id": 1, "submission_time": "2022-01-02 03:04:00"}
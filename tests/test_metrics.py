@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def metrics_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    # start from empty counters, without the collectors registered by the server
+    for name, value in [("_pid", None), ("_counters", {}), ("_histograms", {})]:
+        monkeypatch.setattr(metrics, name, value)
+    monkeypatch.setattr(metrics, "_in_flight", 0)
+    monkeypatch.setattr(metrics, "_collectors", [])
+    return tmp_path
+
+
+def get_dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def save_worker(directory, pid, samples):
+    with open(directory / f"{pid}.json", "w") as file:
+        json.dump({"pid": pid, "samples": samples}, file)
+
+
+def test_workers_are_merged_by_metric_type(metrics_dir):
+    metrics.inc("askmate_db_calls_total", {"function": "get_question"}, 2)
+    metrics.request_started()
+    for pid in (os.getppid(), get_dead_pid()):
+        save_worker(
+            metrics_dir,
+            pid,
+            [
+                ["askmate_db_calls_total", {"function": "get_question"}, 3, "sum"],
+                ["askmate_http_requests_in_flight", {}, 1, "live"],
+                ["askmate_cache_requests_total", {"result": "hit"}, 4, "max"],
+            ],
+        )
+    merged = metrics.collect()
+    # counters of exited workers still count, their in-flight requests do not
+    assert merged[("askmate_db_calls_total", (("function", "get_question"),))] == 8
+    assert merged[("askmate_http_requests_in_flight", ())] == 2
+    # the shared cache reports the same counters from every worker
+    assert merged[("askmate_cache_requests_total", (("result", "hit"),))] == 4
+    assert merged[("askmate_cache_hit_ratio", ())] == 1
+    assert (metrics_dir / f"{os.getpid()}.json").exists()
+
+
+def test_histograms_are_rendered_cumulatively(metrics_dir):
+    for seconds in (0.004, 0.2, 20):
+        metrics.observe(
+            "askmate_http_request_duration_seconds", {"route": "index"}, seconds
+        )
+    lines = metrics.render().splitlines()
+    assert "# TYPE askmate_http_request_duration_seconds histogram" in lines
+    prefix = "askmate_http_request_duration_seconds"
+    assert f'{prefix}_bucket{{le="0.005",route="index"}} 1' in lines
+    assert f'{prefix}_bucket{{le="0.25",route="index"}} 2' in lines
+    assert f'{prefix}_bucket{{le="+Inf",route="index"}} 3' in lines
+    assert f'{prefix}_count{{route="index"}} 3' in lines
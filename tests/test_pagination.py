@@ -0,0 +1,52 @@
+import data_manager
+import utils
+
+
+def test_keyset_reads_the_sort_value_of_the_cursor_row():
+    condition, order, params = data_manager.get_keyset(
+        "title", "id", "question", "ASC", after=7
+    )
+    assert condition.startswith("(title, id) > (")
+    assert "SELECT title, id FROM question WHERE id = %(keyset_id)s" in condition
+    assert order == "title ASC, id ASC"
+    assert params == {"keyset_id": 7}
+
+
+def test_keyset_reads_pages_before_the_cursor_in_reverse():
+    condition, order, params = data_manager.get_keyset(
+        "title", "id", "question", "DESC", before=7
+    )
+    assert condition.startswith("(title, id) > (")
+    assert order == "title ASC, id ASC"
+    assert params == {"keyset_id": 7}
+
+
+def test_first_page_has_no_condition():
+    condition, order, params = data_manager.get_keyset(
+        "vote_number", "id", "question", "DESC"
+    )
+    assert condition == "TRUE"
+    assert order == "vote_number DESC, id DESC"
+    assert params == {"keyset_id": None}
+
+
+def test_cursors_hold_only_the_id():
+    row = {"id": 12, "message": "x" * 10000}
+    assert utils.encode_cursor(row) == "12"
+    assert utils.decode_cursor("12") == 12
+    assert utils.decode_cursor("031f03690527", str) == "031f03690527"
+    assert utils.decode_cursor("not an id") is None
+    assert utils.decode_cursor(None) is None
+
+
+def test_paginate_trims_the_look_ahead_row():
+    rows = [{"id": idx} for idx in range(1, 5)]
+    page, previous_cursor, next_cursor = utils.paginate(rows, 3)
+    assert page == rows[:3]
+    assert (previous_cursor, next_cursor) == (None, "3")
+    page, previous_cursor, next_cursor = utils.paginate(rows[:2], 3, after=5)
+    assert (previous_cursor, next_cursor) == ("1", None)
+    page, previous_cursor, next_cursor = utils.paginate(rows, 3, before=9)
+    assert page == rows[1:]
+    assert (previous_cursor, next_cursor) == ("2", "4")
+    assert utils.paginate([], 3, after=5) == ([], None, None)
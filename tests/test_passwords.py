@@ -0,0 +1,60 @@
+import concurrent.futures
+
+import bcrypt
+import pytest
+
+import data_manager
+import passwords
+import server
+
+
+@pytest.fixture(autouse=True)
+def slots(monkeypatch, tmp_path):
+    monkeypatch.setattr(passwords, "PASSWORD_SLOTS_DIR", str(tmp_path))
+    monkeypatch.setattr(passwords, "PASSWORD_WORKERS", 1)
+    monkeypatch.setattr(passwords, "PASSWORD_QUEUE_TIMEOUT", 0.05)
+    monkeypatch.setattr(passwords, "BCRYPT_ROUNDS", 4)
+
+
+def test_hashes_inline_with_one_thread_per_worker():
+    hashed = passwords.hash_password("secret")
+    assert passwords.get_executor() is None
+    assert passwords.is_valid_password("secret", hashed)
+    assert not passwords.is_valid_password("other", hashed)
+
+
+def test_needs_rehash_compares_the_cost_factor():
+    assert not passwords.needs_rehash(bcrypt.hashpw(b"x", bcrypt.gensalt(4)).decode())
+    assert passwords.needs_rehash(bcrypt.hashpw(b"x", bcrypt.gensalt(5)).decode())
+    assert passwords.needs_rehash("not a bcrypt hash")
+
+
+def test_slots_are_limited_across_callers():
+    with passwords.slot():
+        with pytest.raises(passwords.PasswordQueueFull):
+            with passwords.slot():
+                pass
+    # the slot is free again once released
+    with passwords.slot():
+        pass
+
+
+class StuckExecutor:
+    def submit(self, function, *args):
+        return concurrent.futures.Future()
+
+
+def test_sign_in_answers_503_when_hashing_times_out(monkeypatch):
+    monkeypatch.setattr(passwords, "get_executor", lambda: StuckExecutor())
+    monkeypatch.setattr(passwords, "PASSWORD_TIMEOUT", 0.01)
+    monkeypatch.setattr(
+        data_manager,
+        "get_user_credentials",
+        lambda email: {"id": "1", "user_name": "a", "email": email, "password": "x"},
+    )
+    server.app.config["TESTING"] = True
+    response = server.app.test_client().post(
+        "/sign-in", data={"email": "a@example.com", "password": "secret"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
@@ -0,0 +1,77 @@
+import pytest
+
+import database_common
+import request_memo
+import server
+
+
+class FakeCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FakeConnection:
+    def cursor(self, cursor_factory):
+        return FakeCursor()
+
+
+class FakePool:
+    def putconn(self, connection):
+        pass
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    monkeypatch.setattr(
+        database_common,
+        "get_connection",
+        lambda read: (FakePool(), FakeConnection()),
+    )
+    return []
+
+
+def test_memo_collapses_identical_calls_and_hands_out_copies():
+    memo, calls = request_memo.RequestMemo(), []
+
+    def get_row(row_id):
+        calls.append(row_id)
+        return {"id": row_id}
+
+    first = memo.call("get_row", get_row, (1,), {})
+    first["id"] = 2
+    assert memo.call("get_row", get_row, (1,), {}) == {"id": 1}
+    memo.call("get_row", get_row, (2,), {})
+    assert calls == [1, 2]
+    assert memo.report() == [("get_row(1)", 1)]
+    memo.clear()
+    memo.call("get_row", get_row, (1,), {})
+    assert calls == [1, 2, 1]
+
+
+def test_only_reads_that_opted_in_are_memoized(calls):
+    @database_common.connection_handler(memo=True)
+    def get_small(cursor, row_id):
+        calls.append(("small", row_id))
+        return {"id": row_id}
+
+    @database_common.connection_handler
+    def get_large(cursor):
+        calls.append("large")
+        return [{"id": 1}]
+
+    @database_common.connection_handler
+    def update_row(cursor):
+        calls.append("update")
+
+    with server.app.test_request_context():
+        get_small(1)
+        get_small(1)
+        get_large()
+        get_large()
+        assert calls == [("small", 1), "large", "large"]
+        update_row()
+        get_small(1)
+        assert calls[-1] == ("small", 1)
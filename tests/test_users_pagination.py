@@ -0,0 +1,81 @@
+import datetime
+import html
+import re
+
+import pytest
+
+import data_manager
+import server
+
+# hex varchar ids like the ones the application generates, one made of digits only
+USERS = [
+    {
+        "id": user_id,
+        "user_name": f"user_{index}",
+        "email_address": f"user_{index}@example.com",
+        "registration_date": datetime.datetime(2022, 1, 1 + index // 2),
+        "questions": 0,
+        "answers": 0,
+        "comments": 0,
+        "reputation": index,
+    }
+    for index, user_id in enumerate(
+        ["031f03690527", "0a9c1e7f33b2", "123456789012", "7be2c4d1f0a8", "f00dcafe0001"]
+    )
+]
+NEXT_PAGE = re.compile(r'href="([^"#]+)">Next<')
+USER_LINK = re.compile(r'href="/user/(\w+)"')
+
+
+def get_users_table(
+    order_by="registration_date",
+    order_dir="ASC",
+    limit=None,
+    after=None,
+    before=None,
+):
+    # keyset pagination over USERS, comparing (value, id) with the row the cursor id points at
+    def key(user):
+        return str(user[order_by]), user["id"]
+
+    def position(user_id):
+        assert isinstance(user_id, str)
+        return key(next(user for user in USERS if user["id"] == user_id))
+
+    rows = sorted(USERS, key=key)
+    if after is not None:
+        rows = [user for user in rows if key(user) > position(after)]
+        return rows[:limit]
+    if before is not None:
+        rows = [user for user in rows if key(user) < position(before)]
+        return rows[-limit:]
+    return rows[:limit]
+    if before is not None:
+        assert isinstance(before[1], str)
+        rows = [user for user in rows if key(user) < tuple(before)]
+        return rows[-limit:]
+    return rows[:limit]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(data_manager, "get_users_table", get_users_table)
+    server.app.config["TESTING"] = True
+    return server.app.test_client()
+
+
+def test_next_links_page_through_every_user(client):
+    url, pages = "/users?limit=2", []
+    # a next link that does not advance would page forever, stop after more pages than there are users
+    while url and len(pages) <= len(USERS):
+        response = client.get(url)
+        assert response.status_code == 200
+        body = response.get_data(as_text=True)
+        pages.append(USER_LINK.findall(body))
+        next_page = NEXT_PAGE.search(body)
+        url = html.unescape(next_page.group(1)) if next_page else None
+    assert pages == [
+        ["031f03690527", "0a9c1e7f33b2"],
+        ["123456789012", "7be2c4d1f0a8"],
+        ["f00dcafe0001"],
+    ]
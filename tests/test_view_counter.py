@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+import data_manager
+import view_counter
+
+
+@pytest.fixture
+def flushed(monkeypatch):
+    flushed, done = [], threading.Event()
+
+    def add_views(views):
+        flushed.append((dict(views), threading.current_thread().name))
+        done.set()
+
+    monkeypatch.setattr(data_manager, "add_views", add_views)
+    monkeypatch.setattr(view_counter, "FLUSH_INTERVAL", 60)
+    monkeypatch.setattr(view_counter, "FLUSH_THRESHOLD", 3)
+    # start a fresh buffer and flushing thread
+    monkeypatch.setattr(view_counter, "_pid", None)
+    yield flushed, done
+    # stop the thread
+    view_counter._pid = None
+    view_counter._wake.set()
+
+
+def test_full_buffer_is_written_by_the_background_thread(flushed):
+    flushed, done = flushed
+    view_counter.record_view(1)
+    view_counter.record_view(1)
+    assert view_counter.pending_views(1) == 2
+    view_counter.record_view(2)
+    assert done.wait(5)
+    assert flushed == [({1: 2, 2: 1}, "view-counter")]
+    assert view_counter.pending_views(1) == 0
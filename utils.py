@@ -1,10 +1,29 @@
 from datetime import datetime, timedelta
+from bloom_filter import BloomFilter
 import data_manager
+import database_common
+import passwords
+import logging
 import os
+import threading
+import time
 import uuid
-import bcrypt
+import psycopg2
+
+logger = logging.getLogger(__name__)
 
 PAGE_IDX, TAG_IDX = 1, 3
+SEARCH_PAGE_SIZE = 20
+HOME_PAGE_SIZE, LIST_PAGE_SIZE, MAX_PAGE_SIZE = 5, 20, 100
+# optional in-process Bloom filters of registered emails and user names, rebuilt every refresh period
+# by a background thread of each worker, never by a request
+USE_USER_BLOOM_FILTER = os.environ.get("USER_BLOOM_FILTER") == "1"
+USER_BLOOM_FILTER_REFRESH = float(os.environ.get("USER_BLOOM_FILTER_REFRESH", 300))
+_user_filters = None
+# (email, user name) of the users signed up in this process while the filters are rebuilt
+_user_filters_signed_up = []
+_user_filters_lock = threading.Lock()
+_user_filters_pid = None
 TIME = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
@@ -13,72 +32,128 @@ def get_new_user_id():
     return user_id
 
 
+def load_current_user(session):
+    """Resolves the signed in user once and keeps its id and name in the session"""
+    if "email" in session and "user_id" not in session:
+        user = data_manager.get_user_by_email(session["email"])
+        if user:
+            session.update({"user_id": user["id"], "username": user["user_name"]})
+
+
 def get_current_user_id(session):
-    return (
-        data_manager.get_user_id(session["email"]).get("id")
-        if "email" in session
-        else None
-    )
+    load_current_user(session)
+    return session.get("user_id")
 
 
 def get_username(session):
-    if "email" in session:
-        return data_manager.get_username(session.get("email")).get("user_name")
+    load_current_user(session)
+    return session.get("username")
+
+
+def sign_in(session, user):
+    sign_out(session)
+    session.update(
+        {"email": user["email"], "user_id": user["id"], "username": user["user_name"]}
+    )
+
+
+def sign_out(session):
+    for key in ("email", "user_id", "username"):
+        session.pop(key, None)
+
+
+def start_user_filters():
+    """Starts the thread (re)building the Bloom filters of this process, once per process"""
+    global _user_filters_pid
+    if not USE_USER_BLOOM_FILTER:
+        return
+    with _user_filters_lock:
+        if _user_filters_pid == os.getpid():
+            return
+        _user_filters_pid = os.getpid()
+    threading.Thread(
+        target=refresh_user_filters, name="user-filters", daemon=True
+    ).start()
+
+
+def refresh_user_filters():
+    global _user_filters, _user_filters_signed_up
+    while True:
+        try:
+            with _user_filters_lock:
+                _user_filters_signed_up = []
+            identities = data_manager.get_user_identities()
+            # room for the users signing up until the next refresh
+            capacity = 2 * len(identities) + 1000
+            emails, user_names = BloomFilter(capacity), BloomFilter(capacity)
+            for identity in identities:
+                emails.add(identity["email_address"])
+                user_names.add(identity["user_name"])
+            del identities
+            with _user_filters_lock:
+                # sign-ups committed after the load started may be missing from it
+                for email, user_name in _user_filters_signed_up:
+                    emails.add(email)
+                    user_names.add(user_name)
+                _user_filters = (emails, user_names)
+        except Exception:
+            logger.exception("could not load the user Bloom filters")
+        time.sleep(USER_BLOOM_FILTER_REFRESH)
+
+
+def get_user_filters():
+    """Returns the (emails, user names) Bloom filters of this process, None until they are first built"""
+    start_user_filters()
+    return _user_filters
+
+
+def add_to_user_filters(email, user_name):
+    with _user_filters_lock:
+        _user_filters_signed_up.append((email, user_name))
+        if _user_filters is not None:
+            _user_filters[0].add(email)
+            _user_filters[1].add(user_name)
 
 
 def is_email_already_register(request):
-    return request.form["email"] in [
-        email["email_address"] for email in data_manager.get_user_emails()
-    ]
+    email = request.form["email"]
+    # users registered through another worker since the last refresh are caught by the unique constraint
+    filters = get_user_filters() if USE_USER_BLOOM_FILTER else None
+    if filters is not None and email not in filters[0]:
+        return False
+    return data_manager.is_email_registered(email)
 
 
 def is_username_taken(request):
-    return request.form["username"] in [
-        username["user_name"] for username in data_manager.get_user_names()
-    ]
+    user_name = request.form["username"]
+    filters = get_user_filters() if USE_USER_BLOOM_FILTER else None
+    if filters is not None and user_name not in filters[1]:
+        return False
+    return data_manager.is_user_name_taken(user_name)
 
 
 def are_valid_credentials(request):
-    if is_email_already_register(request):
-        user_password = data_manager.get_user_pass(request.form["email"])["password"]
-        return is_valid_password(request.form["password"], user_password)
+    """Returns the signed in user when the credentials are valid"""
+    user = data_manager.get_user_credentials(request.form["email"])
+    if user and is_valid_password(request.form["password"], user["password"]):
+        # hashes made with another cost factor are upgraded while the plain text is at hand
+        if passwords.needs_rehash(user["password"]):
+            data_manager.update_user_password(
+                user["id"], hash_password(request.form["password"])
+            )
+        return {
+            "id": user["id"],
+            "user_name": user["user_name"],
+            "email": request.form["email"],
+        }
 
 
 def hash_password(plain_text_password):
-    hashed_bytes = bcrypt.hashpw(plain_text_password.encode("utf-8"), bcrypt.gensalt())
-    return hashed_bytes.decode("utf-8")
+    return passwords.hash_password(plain_text_password)
 
 
 def is_valid_password(plain_text_password, hashed_password):
-    hashed_bytes_password = hashed_password.encode("utf-8")
-    return bcrypt.checkpw(plain_text_password.encode("utf-8"), hashed_bytes_password)
-
-
-def has_question_privilege(session, question_id):
-    if "email" in session:
-        current_user_id = data_manager.get_user_id(session["email"]).get("id")
-        question_owner_id = data_manager.get_user_id_by_question_id(question_id).get(
-            "user_id"
-        )
-        return question_owner_id == current_user_id
-
-
-def has_answer_privilege(session, answer_id):
-    if "email" in session:
-        current_user_id = data_manager.get_user_id(session["email"]).get("id")
-        answer_owner_id = data_manager.get_user_id_by_answer_id(answer_id).get(
-            "user_id"
-        )
-        return current_user_id == answer_owner_id
-
-
-def has_comment_privilege(session, comment_id):
-    if "email" in session:
-        current_user_id = data_manager.get_user_id(session["email"]).get("id")
-        comment_owner_id = data_manager.get_user_id_by_comment_id(comment_id).get(
-            "user_id"
-        )
-        return current_user_id == comment_owner_id
+    return passwords.is_valid_password(plain_text_password, hashed_password)
 
 
 def update_to_pretty_time(real_dict_list):
@@ -99,6 +174,59 @@ def get_formatted_dicts(dicts):
     return dicts
 
 
+def add_questions_view_data(questions):
+    """Adds tags and author names to every question with a constant number of queries"""
+    view_data = data_manager.get_questions_view_data(
+        [question["id"] for question in questions]
+    )
+    for question in questions:
+        question.update(view_data[question["id"]])
+    return questions
+
+
+def format_question_thread(question):
+    posts = [question] + question["comments"] + question["answers"]
+    for answer in question["answers"]:
+        posts += answer["comments"]
+    update_to_pretty_time(get_formatted_dicts(posts))
+    return question
+
+
+def encode_cursor(row):
+    return str(row["id"])
+
+
+def decode_cursor(token, id_type=int):
+    """Returns the id a cursor points at, id_type is the type of the id column (str for users)"""
+    if not token:
+        return None
+    try:
+        return id_type(token)
+    except ValueError:
+        return None
+
+
+def get_page_limit(args):
+    limit = args.get("limit", LIST_PAGE_SIZE, type=int)
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+
+def paginate(rows, limit, after=None, before=None):
+    """Trims the extra look-ahead row and returns (rows, previous page cursor, next page cursor)"""
+    has_more = len(rows) > limit
+    if before:
+        rows = rows[-limit:]
+        has_previous, has_next = has_more, True
+    else:
+        rows = rows[:limit]
+        has_previous, has_next = after is not None, has_more
+    if not rows:
+        return rows, None, None
+    previous_cursor = encode_cursor(rows[0]) if has_previous else None
+    next_cursor = encode_cursor(rows[-1]) if has_next else None
+    return rows, previous_cursor, next_cursor
+
+
 def get_style(style_mode):
     if style_mode == "day":
         return "whitesmoke", "black"
@@ -106,14 +234,6 @@ def get_style(style_mode):
         return "black", "whitesmoke"
 
 
-def get_keys(real_dict_list):
-    accepted_status = []
-    if real_dict_list:
-        for real_dict in real_dict_list:
-            accepted_status.append(real_dict["accepted_status"])
-    return accepted_status
-
-
 def get_table_page_style(style_mode):
     if style_mode == "day":
         return "light", "dark"
@@ -122,31 +242,17 @@ def get_table_page_style(style_mode):
 
 
 def vote_question(idx, value, session):
-    question_owner_id = data_manager.get_user_id_by_question_id(idx).get("user_id")
-    current_user_id = get_current_user_id(session)
-    vote_status = data_manager.get_vote_status("question_id", idx)
-    vote_right = True
-    for vote in vote_status:
-        if vote["id"] == current_user_id:
-            vote_right = False
-    if vote_right and (question_owner_id != current_user_id):
-        data_manager.add_user_vote_status((current_user_id, idx))
-        data_manager.vote_question(idx, int(value))
-        data_manager.update_reputation(idx, 5 if int(value) > 0 else -2)
+    value = int(value)
+    return data_manager.vote_question(
+        idx, get_current_user_id(session), value, 5 if value > 0 else -2
+    )
 
 
 def vote_answer(idx, value, session):
-    answer_owner_id = data_manager.get_user_id_by_answer_id(idx).get("user_id")
-    current_user_id = get_current_user_id(session)
-    vote_status = data_manager.get_vote_status("answer_id", idx)
-    vote_right = True
-    for vote in vote_status:
-        if vote["id"] == current_user_id:
-            vote_right = False
-    if vote_right and (answer_owner_id != current_user_id):
-        data_manager.add_user_vote_status((current_user_id, None, idx))
-        data_manager.vote_answer(idx, int(value))
-        data_manager.update_reputation(idx, 10 if int(value) > 0 else -2)
+    value = int(value)
+    return data_manager.vote_answer(
+        idx, get_current_user_id(session), value, 10 if value > 0 else -2
+    )
 
 
 def get_pretty_time(posted_time):
@@ -195,47 +301,53 @@ def delete_img(files_path):
             os.remove(abs_file_path)
 
 
-def add_and_redirect(page, request, email):
+def add_and_redirect(page, request, user_id):
     page_id = get_page_id(page)
-    user_id = data_manager.get_user_id(email).get("id")
 
-    if page == "add-question":
-        add_question(request, user_id)
-        page_id = data_manager.get_new_question_id()["new_id"]
+    with database_common.unit_of_work():
+        if page == "add-question":
+            page_id = add_question(request, user_id)
 
-    if page.endswith("new-answer"):
-        add_answer(page_id, request, user_id)
+        if page.endswith("new-answer"):
+            add_answer(page_id, request, user_id)
 
-    if page.endswith("new-comment"):
-        redirect = add_comment_and_redirect(page, page_id, request, user_id)
-        return redirect
+        if page.endswith("new-comment"):
+            redirect = add_comment_and_redirect(page, page_id, request, user_id)
+            return redirect
 
-    if page.endswith("new-tag"):
-        add_tag(page_id, request)
+        if page.endswith("new-tag"):
+            add_tag(page_id, request)
 
     return f"/question/{page_id}"
 
 
 def add_user(request):
-    data_manager.add_user(
-        (
-            get_new_user_id(),
-            request.form["username"],
-            request.form["email"],
-            TIME,
-            hash_password(request.form["password"]),
-            0,
+    """Registers the user and returns None, or the name of the field that is already taken"""
+    try:
+        data_manager.add_user(
+            (
+                get_new_user_id(),
+                request.form["username"],
+                request.form["email"],
+                TIME,
+                hash_password(request.form["password"]),
+                0,
+            )
         )
-    )
+    except psycopg2.IntegrityError as exception:
+        return (
+            "email" if "email" in (exception.diag.constraint_name or "") else "username"
+        )
+    if USE_USER_BLOOM_FILTER:
+        add_to_user_filters(request.form["email"], request.form["username"])
 
 
 def add_tag(page_id, request):
-    all_tags, question_tags, question_tags_string = get_tags(page_id)
-    if "tag" in request.form.keys():
-        if not request.form["tag"] in [d["name"] for d in question_tags]:
+    # the inserts skip tags that exist already, the cached tag lists may be stale and never decide what is written
+    with database_common.unit_of_work():
+        if "tag" in request.form.keys():
             data_manager.add_tag_to_question(request.form["tag"], page_id)
-    else:
-        if not request.form["new_tag"] in [d["name"] for d in question_tags]:
+        else:
             data_manager.add_tag(request.form["new_tag"])
             data_manager.add_tag_to_question(request.form["new_tag"], page_id)
 
@@ -258,7 +370,7 @@ def add_comment_and_redirect(page, page_id, request, user_id):
 def add_answer(page_id, request, user_id):
     file_name = saved_img(request)
     new_answer = (TIME, 0, False, page_id, user_id, request.form["message"], file_name)
-    data_manager.add_answer(new_answer)
+    return data_manager.add_answer(new_answer)
 
 
 def add_question(request, user_id):
@@ -272,7 +384,7 @@ def add_question(request, user_id):
         request.form["message"],
         file_name,
     )
-    data_manager.add_question(new_question)
+    return data_manager.add_question(new_question)
 
 
 def get_tags(page_id):
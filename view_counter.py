@@ -0,0 +1,78 @@
+# Buffers question view increments in memory and writes them to the database in batches,
+# so reading a question no longer takes a row lock on it.
+# Every worker process keeps its own buffer, the increments are additive so workers never overwrite each other.
+# Only the background thread writes the buffer, a request that fills it just wakes the thread up, so the write
+# never runs inside a request and does not pin its session to the primary.
+import atexit
+import logging
+import os
+import threading
+
+import data_manager
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.environ.get("VIEW_FLUSH_INTERVAL", 5))
+FLUSH_THRESHOLD = int(os.environ.get("VIEW_FLUSH_THRESHOLD", 500))
+
+_lock = threading.Lock()
+_pending = {}
+_pending_total = 0
+_pid = None
+_wake = threading.Event()
+
+
+def _start_process():
+    # called with the lock held, a forked worker must not flush the views buffered by its parent
+    global _pending, _pending_total, _pid, _wake
+    _pid = os.getpid()
+    _pending, _pending_total = {}, 0
+    _wake = threading.Event()
+    threading.Thread(
+        target=_flush_periodically, name="view-counter", daemon=True
+    ).start()
+
+
+def _flush_periodically():
+    pid = os.getpid()
+    wake = _wake
+    while _pid == pid:
+        wake.wait(FLUSH_INTERVAL)
+        wake.clear()
+        flush()
+
+
+def record_view(question_id):
+    global _pending_total
+    with _lock:
+        if _pid != os.getpid():
+            _start_process()
+        _pending[question_id] = _pending.get(question_id, 0) + 1
+        _pending_total += 1
+        if _pending_total >= FLUSH_THRESHOLD:
+            _wake.set()
+
+
+def pending_views(question_id):
+    with _lock:
+        return _pending.get(question_id, 0) if _pid == os.getpid() else 0
+
+
+def flush():
+    global _pending, _pending_total
+    with _lock:
+        if _pid != os.getpid() or not _pending:
+            return
+        views, _pending, _pending_total = _pending, {}, 0
+    try:
+        data_manager.add_views(views)
+    except Exception:
+        logger.exception("could not flush %s question views", sum(views.values()))
+        # keep the views for the next flush instead of losing them
+        with _lock:
+            for question_id, count in views.items():
+                _pending[question_id] = _pending.get(question_id, 0) + count
+                _pending_total += count
+
+
+atexit.register(flush)
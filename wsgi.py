@@ -0,0 +1,8 @@
+# Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+# The session cookies are signed with SECRET_KEY, which must be the same for every worker and survive restarts.
+import os
+
+if not os.environ.get("SECRET_KEY"):
+    raise RuntimeError("SECRET_KEY must be set to run more than one worker")
+
+from server import app  # noqa: E402